@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""Memory benchmark of Pipeline.download_data on growing numbers of
+countries of the global workload. Each number of countries is run in a fresh
+process so that its peak memory is its own. Exits with status 1 if the peak
+memory of the most countries is more than the threshold above that of the
+fewest. Run with:
+
+    python benchmarks/bench_memory.py --constant-memory
+    python benchmarks/bench_memory.py --constant-memory --asynchronous
+"""
+
+import argparse
+import json
+import logging
+import subprocess
+import sys
+from pathlib import Path
+
+from bench_pipeline import BENCHMARKS_DIR, run
+
+DEFAULT_COUNTS = "10,40,0"
+
+
+def run_in_process(countries: int, args: argparse.Namespace) -> dict:
+    """Run the pipeline on the first countries of the global workload (0 for
+    all) in a new Python process and get its metrics"""
+    command = [
+        sys.executable,
+        __file__,
+        "--countries",
+        str(countries),
+        "--data-dir",
+        str(args.data_dir),
+    ]
+    if args.constant_memory:
+        command.append("--constant-memory")
+    if args.asynchronous:
+        command.append("--asynchronous")
+    output = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--counts",
+        default=DEFAULT_COUNTS,
+        help="Numbers of countries to run, comma separated, 0 for all",
+    )
+    parser.add_argument(
+        "--constant-memory",
+        action="store_true",
+        help="Keep only bounded state while processing countries",
+    )
+    parser.add_argument(
+        "--asynchronous",
+        action="store_true",
+        help="Stream, transform and write countries concurrently",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Allowed fractional growth in peak memory",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=BENCHMARKS_DIR / "data",
+        help="Folder in which generated workloads are kept",
+    )
+    parser.add_argument("--countries", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.countries is not None:
+        metrics = run(
+            "global",
+            args.data_dir,
+            "row",
+            1,
+            1,
+            [],
+            asynchronous=args.asynchronous,
+            constant_memory=args.constant_memory,
+            limit=args.countries,
+        )
+        print(json.dumps(metrics))
+        return 0
+
+    results = {}
+    for countries in (int(x) for x in args.counts.split(",")):
+        metrics = run_in_process(countries, args)
+        name = str(countries or "all")
+        results[name] = {
+            "rows_read": metrics["rows_read"],
+            "elapsed_seconds": metrics["elapsed_seconds"],
+            "peak_rss_mb": metrics["peak_rss_mb"],
+        }
+        print(f"{name} countries: {json.dumps(results[name])}", flush=True)
+    peak_rss = [result["peak_rss_mb"] for result in results.values()]
+    growth = peak_rss[-1] / peak_rss[0] - 1
+    print(f"Peak memory growth {growth:.1%}")
+    if growth > args.threshold:
+        print(f"REGRESSION: peak memory grew by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
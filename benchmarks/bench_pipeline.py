@@ -0,0 +1,229 @@
+#!/usr/bin/python
+"""End-to-end benchmark of Pipeline.download_data on a synthetic workload
+served by a local HDX stand-in. Measures elapsed time, rows/s, peak memory and
+the time of each stage, and compares them with the checked-in baselines. Exits
+with status 1 if any is worse than its baseline by more than the threshold.
+Run with:
+
+    python benchmarks/bench_pipeline.py --workload sample
+    python benchmarks/bench_pipeline.py --workload global --update-baseline
+"""
+
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from hdx.api.configuration import Configuration
+from hdx.api.utilities.hdx_error_handler import HDXErrorHandler
+from hdx.location.adminlevel import AdminLevel
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+from hdx.utilities.retriever import Retrieve
+from standin import StandIn
+from workload import SAMPLE_COUNTRIES, TODAY, generate
+
+from hdx.scraper.wfp_rainfall.pipeline import Pipeline
+
+BENCHMARKS_DIR = Path(__file__).parent
+BASELINES_PATH = BENCHMARKS_DIR / "baselines.json"
+PROJECT_CONFIG_PATH = (
+    BENCHMARKS_DIR.parent
+    / "src"
+    / "hdx"
+    / "scraper"
+    / "wfp_rainfall"
+    / "config"
+    / "project_configuration.yaml"
+)
+WORKLOADS = {"sample": SAMPLE_COUNTRIES, "global": None}
+# Stages quicker than this in the baseline are too noisy to compare
+MIN_STAGE_SECONDS = 1.0
+
+
+def run(
+    workload: str,
+    data_dir: Path,
+    engine: str,
+    processes: int,
+    repeat: int,
+    extra_formats: list[str],
+    cache: bool = False,
+    asynchronous: bool = False,
+    constant_memory: bool = False,
+    limit: int | None = None,
+) -> dict:
+    countries = generate(data_dir / workload, WORKLOADS[workload])
+    if limit:
+        countries = countries[:limit]
+    with StandIn(data_dir / workload, countries) as standin:
+        Configuration._create(
+            hdx_site="benchmark",
+            hdx_read_only=True,
+            user_agent="benchmark",
+            hdx_config_dict={"hdx_benchmark_site": {"url": standin.url}},
+            project_config_yaml=PROJECT_CONFIG_PATH,
+        )
+        Country.countriesdata(use_live=False)
+        AdminLevel.admin_url = standin.admin_url
+        AdminLevel.formats_url = standin.formats_url
+        best = None
+        for _ in range(repeat):
+            with TemporaryDirectory() as tempdir:
+                with Download(user_agent="benchmark") as downloader:
+                    retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+                    pipeline = Pipeline(
+                        Configuration.read(),
+                        retriever,
+                        tempdir,
+                        HDXErrorHandler(),
+                        TODAY,
+                        engine=engine,
+                        processes=processes,
+                        report=True,
+                        extra_formats=extra_formats,
+                        cache_dir=str(data_dir / f"cache-{workload}")
+                        if cache
+                        else None,
+                        asynchronous=asynchronous,
+                        constant_memory=constant_memory,
+                    )
+                    pipeline.download_data(countries)
+                    with open(pipeline.save_report()) as fp:
+                        report = json.load(fp)
+            if best is None or report["elapsed_seconds"] < best["elapsed_seconds"]:
+                best = report
+    peak_rss = max(best["peak_rss_bytes"].values(), default=0)
+    rows_written = best["totals"].get("written", 0)
+    return {
+        "rows_read": best["totals"].get("read", 0),
+        "rows_written": rows_written,
+        "elapsed_seconds": round(best["elapsed_seconds"], 3),
+        "rows_per_second": round(rows_written / best["elapsed_seconds"]),
+        "peak_rss_mb": round(peak_rss / 1048576, 1),
+        "stages": {
+            name: round(stage["seconds"], 3) for name, stage in best["stages"].items()
+        },
+    }
+
+
+def compare(metrics: dict, baseline: dict, threshold: float) -> list[str]:
+    """Get descriptions of metrics that are worse than baseline by more than
+    threshold (a fraction) or differ in number of rows"""
+    regressions = []
+    for key in ("rows_read", "rows_written"):
+        if metrics[key] != baseline[key]:
+            regressions.append(f"{key} {metrics[key]} != baseline {baseline[key]}")
+    limit = 1 + threshold
+    for key in ("elapsed_seconds", "peak_rss_mb"):
+        if metrics[key] > baseline[key] * limit:
+            regressions.append(f"{key} {metrics[key]} > baseline {baseline[key]}")
+    if metrics["rows_per_second"] * limit < baseline["rows_per_second"]:
+        regressions.append(
+            f"rows_per_second {metrics['rows_per_second']} < "
+            f"baseline {baseline['rows_per_second']}"
+        )
+    for name, seconds in baseline["stages"].items():
+        if seconds < MIN_STAGE_SECONDS:
+            continue
+        current = metrics["stages"].get(name, 0)
+        if current > seconds * limit:
+            regressions.append(f"stage {name} {current}s > baseline {seconds}s")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="sample")
+    parser.add_argument("--engine", choices=("row", "columnar"), default="row")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--extra-formats",
+        default="",
+        help="Also write outputs as csv.gz and/or parquet, comma separated",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Use a download cache in the data folder, warm after the first run",
+    )
+    parser.add_argument(
+        "--asynchronous",
+        action="store_true",
+        help="Stream, transform and write countries concurrently",
+    )
+    parser.add_argument(
+        "--constant-memory",
+        action="store_true",
+        help="Keep only bounded state while processing countries",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Keep fastest run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Allowed fraction worse than baseline",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=BENCHMARKS_DIR / "data",
+        help="Folder in which generated workloads are kept",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    name = args.workload
+    if args.engine != "row" or args.processes != 1:
+        name = f"{name}-{args.engine}-{args.processes}"
+    extra_formats = [x for x in args.extra_formats.split(",") if x]
+    if extra_formats:
+        name = f"{name}-{'-'.join(extra_formats)}"
+    if args.cache:
+        name = f"{name}-cache"
+    if args.asynchronous:
+        name = f"{name}-asynchronous"
+    if args.constant_memory:
+        name = f"{name}-constant-memory"
+    metrics = run(
+        args.workload,
+        args.data_dir,
+        args.engine,
+        args.processes,
+        args.repeat,
+        extra_formats,
+        args.cache,
+        args.asynchronous,
+        args.constant_memory,
+    )
+    print(json.dumps({name: metrics}, indent=1))
+
+    baselines = {}
+    if BASELINES_PATH.exists():
+        with open(BASELINES_PATH) as fp:
+            baselines = json.load(fp)
+    if args.update_baseline:
+        baselines[name] = metrics
+        with open(BASELINES_PATH, "w") as fp:
+            json.dump(baselines, fp, indent=1, sort_keys=True)
+            fp.write("\n")
+        print(f"Updated baseline {name}")
+        return 0
+    baseline = baselines.get(name)
+    if baseline is None:
+        print(f"No baseline for {name}")
+        return 0
+    regressions = compare(metrics, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if regressions:
+        return 1
+    print(f"No regressions against baseline {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
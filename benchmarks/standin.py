@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""Local stand-in for HDX serving the CKAN package_search action, country
+rainfall files and the global p-code files over HTTP. Files have an ETag and
+are answered with 304 Not Modified if it matches If-None-Match."""
+
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from shutil import copyfileobj
+from urllib.parse import parse_qsl, urlparse
+
+from workload import PCODE_LENGTHS_PATH, PCODES_PATH, get_dataset
+
+
+class StandIn:
+    """Serves datasets for countries from the files in folder. Use as a
+    context manager, the server listening on a free local port until exit.
+
+    Args:
+        folder: Folder of country files named {iso3}.csv
+        countries: Countries to return from package_search
+    """
+
+    def __init__(self, folder: Path, countries: list[str]):
+        self._folder = folder
+        self._countries = countries
+        self._server = None
+        self._thread = None
+        self.url = ""
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def admin_url(self) -> str:
+        return f"{self.url}/pcodes/{PCODES_PATH.name}"
+
+    @property
+    def formats_url(self) -> str:
+        return f"{self.url}/pcodes/{PCODE_LENGTHS_PATH.name}"
+
+    def _count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path.split("/")[1]] += 1
+
+    def _search(self, data: dict) -> dict:
+        start = int(data.get("start", 0))
+        rows = int(data.get("rows", 1000))
+        datasets = [get_dataset(iso3, self.url) for iso3 in self._countries]
+        return {
+            "success": True,
+            "result": {
+                "count": len(datasets),
+                "results": datasets[start : start + rows],
+            },
+        }
+
+    def _get_handler(self) -> type[BaseHTTPRequestHandler]:
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, result: dict) -> None:
+                body = json.dumps(result).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_file(self, path: Path) -> None:
+                if not path.is_file():
+                    self.send_error(404)
+                    return
+                stat = path.stat()
+                etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+                if self.headers.get("If-None-Match") == etag:
+                    standin._count("/not_modified")
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv")
+                self.send_header("Content-Length", str(stat.st_size))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                with open(path, "rb") as fp:
+                    copyfileobj(fp, self.wfile, 1048576)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                standin._count(url.path)
+                if url.path.endswith("/package_search"):
+                    self._send_json(standin._search(dict(parse_qsl(url.query))))
+                elif url.path.startswith("/download/"):
+                    self._send_file(standin._folder / Path(url.path).name)
+                elif url.path == f"/pcodes/{PCODES_PATH.name}":
+                    self._send_file(PCODES_PATH)
+                elif url.path == f"/pcodes/{PCODE_LENGTHS_PATH.name}":
+                    self._send_file(PCODE_LENGTHS_PATH)
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                standin._count(url.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                if not url.path.endswith("/package_search"):
+                    self.send_error(404)
+                    return
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    data = json.loads(body) if body else {}
+                else:
+                    data = dict(parse_qsl(body))
+                self._send_json(standin._search(data))
+
+        return Handler
+
+    def __enter__(self) -> "StandIn":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._get_handler())
+        self._server.daemon_threads = True
+        host, port = self._server.server_address
+        self.url = f"http://{host}:{port}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+"""Synthetic 5ytd rainfall files and dataset metadata for benchmarks. Every
+country gets one row per dekad over five years for each of its admin 1 and
+admin 2 units in the global p-codes file, so files have the same number of
+rows as the real ones."""
+
+import csv
+import json
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from uuid import NAMESPACE_URL, uuid5
+from zlib import crc32
+
+from hdx.utilities.dateparse import parse_date
+
+PCODES_PATH = (
+    Path(__file__).parent.parent
+    / "tests"
+    / "fixtures"
+    / "input"
+    / "download-global-pcodes-adm-1-2.csv"
+)
+PCODE_LENGTHS_PATH = PCODES_PATH.parent / "download-global-pcode-lengths.csv"
+TODAY = parse_date("2025-07-08")
+
+# Subset with HRP, GHO only and other countries as well as BRA which has no
+# admin 2 output
+SAMPLE_COUNTRIES = (
+    "AFG",
+    "BRA",
+    "COL",
+    "IND",
+    "KEN",
+    "MOZ",
+    "NGA",
+    "PER",
+    "SDN",
+    "YEM",
+)
+
+_HEADERS = (
+    "date",
+    "adm_level",
+    "adm_id",
+    "PCODE",
+    "n_pixels",
+    "rfh",
+    "rfh_avg",
+    "r1h",
+    "r1h_avg",
+    "r3h",
+    "r3h_avg",
+    "rfq",
+    "r1q",
+    "r3q",
+    "version",
+)
+
+
+def get_units() -> dict[str, list[tuple[str, str]]]:
+    """Get admin level and p-code of every admin 1 and 2 unit by country"""
+    units = defaultdict(list)
+    with open(PCODES_PATH, newline="", encoding="utf-8-sig") as fp:
+        for row in csv.DictReader(fp):
+            if row["Admin Level"] in ("1", "2"):
+                units[row["Location"]].append((row["Admin Level"], row["P-Code"]))
+    return units
+
+
+def get_dekads(today: datetime, years: int = 5) -> list[str]:
+    """Get the start dates of the dekads in the years up to today"""
+    start = today - timedelta(days=365 * years)
+    dekads = []
+    year, month = start.year, start.month
+    while True:
+        for day in (1, 11, 21):
+            date = datetime(year, month, day, tzinfo=today.tzinfo)
+            if date > today:
+                return dekads
+            if date >= start:
+                dekads.append(date.strftime("%Y-%m-%d"))
+        month += 1
+        if month > 12:
+            year += 1
+            month = 1
+
+
+def write_country(
+    path: Path, countryiso3: str, units: list[tuple[str, str]], dekads: list[str]
+) -> int:
+    """Write a country's 5ytd file. One admin 2 p-code is unknown so that
+    p-code lookups that fall back to complete_admins are exercised.
+
+    Returns:
+        Number of rows written
+    """
+    rng = random.Random(crc32(countryiso3.encode()))
+    units = units + [("2", f"{countryiso3[:2]}99999")]
+    pixels = [f"{rng.randint(10, 5000)}.0" for _ in units]
+    no_rows = 0
+    with open(path, "w", newline="", encoding="utf-8") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(_HEADERS)
+        for i, date in enumerate(dekads):
+            if i >= len(dekads) - 1:
+                version = "forecast"
+            elif i >= len(dekads) - 3:
+                version = "prelim"
+            else:
+                version = "final"
+            rows = []
+            for adm_id, (admin_level, pcode) in enumerate(units):
+                values = [rng.uniform(0, 300) for _ in range(6)]
+                anomalies = [f"{rng.uniform(0, 200):.5f}" for _ in range(3)]
+                if rng.random() < 0.01:
+                    anomalies[2] = ""
+                rows.append(
+                    (
+                        date,
+                        admin_level,
+                        900000 + adm_id,
+                        pcode,
+                        pixels[adm_id],
+                        *(f"{value:.6f}" for value in values),
+                        *anomalies,
+                        version,
+                    )
+                )
+            writer.writerows(rows)
+            no_rows += len(rows)
+    return no_rows
+
+
+def get_dataset(countryiso3: str, base_url: str) -> dict:
+    """Get the HDX metadata of a country's rainfall dataset"""
+    name = f"{countryiso3.lower()}-rainfall-subnational"
+    dataset_id = str(uuid5(NAMESPACE_URL, name))
+    resource_name = f"{countryiso3.lower()}-rainfall-adm2-5ytd.csv"
+    return {
+        "id": dataset_id,
+        "name": name,
+        "title": f"{countryiso3}: Rainfall Indicators at Subnational Level",
+        "resources": [
+            {
+                "id": str(uuid5(NAMESPACE_URL, resource_name)),
+                "package_id": dataset_id,
+                "name": resource_name,
+                "format": "CSV",
+                "url": f"{base_url}/download/{countryiso3}.csv",
+                "last_modified": "2025-07-01T00:00:00",
+            }
+        ],
+    }
+
+
+def generate(folder: Path, countries: tuple[str, ...] | None = None) -> list[str]:
+    """Write the 5ytd file of each country into folder unless already there
+
+    Args:
+        folder: Folder for the files
+        countries: Countries to generate. Defaults to None (all with p-codes).
+
+    Returns:
+        Countries generated
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    units = get_units()
+    if countries is None:
+        countries = tuple(sorted(units))
+    dekads = get_dekads(TODAY)
+    summary_path = folder / "workload.json"
+    if summary_path.exists():
+        with open(summary_path) as fp:
+            summary = json.load(fp)
+        if summary["countries"] == list(countries):
+            return list(countries)
+    no_rows = 0
+    for countryiso3 in countries:
+        no_rows += write_country(
+            folder / f"{countryiso3}.csv", countryiso3, units[countryiso3], dekads
+        )
+    with open(summary_path, "w") as fp:
+        json.dump({"countries": list(countries), "rows": no_rows}, fp)
+    return list(countries)
@@ -23,6 +23,9 @@ logger = logging.getLogger(__name__)
 
 _USER_AGENT_LOOKUP = "hdx-scraper-wfp-rainfall"
 _SAVED_DATA_DIR = "saved_data"  # Keep in repo to avoid deletion in /tmp
+_STATE_DIR = "state_data"  # Kept between runs to reuse unchanged countries
+_WORKING_DIR = "working_data"  # Outputs and checkpoint kept to resume a failed run
+_CACHE_DIR = "cache_data"  # Downloads kept between runs, refreshed if changed
 _UPDATED_BY_SCRIPT = "HDX Scraper: WFP Rainfall"
 
 
@@ -30,6 +33,15 @@ def main(
     save: bool = False,
     use_saved: bool = False,
     err_to_hdx: bool = False,
+    full_refresh: bool = False,
+    engine: str = "row",
+    processes: int = 1,
+    report: bool = False,
+    history: bool = False,
+    extra_formats: str = "",
+    resume: bool = False,
+    asynchronous: bool = False,
+    constant_memory: bool = False,
 ) -> None:
     """Generate datasets and create them in HDX
 
@@ -37,6 +49,15 @@ def main(
         save (bool): Save downloaded data. Defaults to False.
         use_saved (bool): Use saved data. Defaults to False.
         err_to_hdx (bool): Whether to write any errors to HDX metadata. Defaults to False.
+        full_refresh (bool): Ignore the previous run and process all countries. Defaults to False.
+        engine (str): Transform engine, row or columnar (needs numpy). Defaults to "row".
+        processes (int): Number of processes transforming countries. Defaults to 1.
+        report (bool): Write a run report and keep it with the outputs. Defaults to False.
+        history (bool): Keep admin 2 rows of all years, partitioning outputs. Defaults to False.
+        extra_formats (str): Also write outputs as csv.gz and/or parquet, comma separated. Defaults to "".
+        resume (bool): Resume a failed run from its checkpoint. Defaults to False.
+        asynchronous (bool): Stream, transform and write countries concurrently. Defaults to False.
+        constant_memory (bool): Keep only bounded state while processing countries. Defaults to False.
 
     Returns:
         None
@@ -59,20 +80,50 @@ def main(
 
                 today = now_utc()
                 wfp_rainfall = Pipeline(
-                    configuration, retriever, temp_folder, error_handler, today
+                    configuration,
+                    retriever,
+                    _WORKING_DIR,
+                    error_handler,
+                    today,
+                    state_dir=_STATE_DIR,
+                    full_refresh=full_refresh,
+                    engine=engine,
+                    processes=processes,
+                    report=report,
+                    history=history,
+                    extra_formats=[x for x in extra_formats.split(",") if x],
+                    checkpoint=True,
+                    resume=resume,
+                    cache_dir=_CACHE_DIR,
+                    asynchronous=asynchronous,
+                    constant_memory=constant_memory,
                 )
-                wfp_rainfall.download_data()
-                dataset = wfp_rainfall.generate_global_dataset()
-                dataset.update_from_yaml(
-                    path=script_dir_plus_file(
-                        join("config", "hdx_dataset_static.yaml"), main
+                try:
+                    wfp_rainfall.download_data()
+                    dataset = wfp_rainfall.generate_global_dataset()
+                    dataset.update_from_yaml(
+                        path=script_dir_plus_file(
+                            join("config", "hdx_dataset_static.yaml"), main
+                        )
                     )
-                )
-                dataset.create_in_hdx(
-                    remove_additional_resources=True,
-                    match_resource_order=False,
-                    updated_by_script=_UPDATED_BY_SCRIPT,
-                )
+                    if history:
+                        dataset.update_from_yaml(
+                            path=script_dir_plus_file(
+                                join("config", "hdx_dataset_static_history.yaml"),
+                                main,
+                            )
+                        )
+                    with wfp_rainfall.report.stage("upload"):
+                        statuses = dataset.create_in_hdx(
+                            remove_additional_resources=True,
+                            match_resource_order=False,
+                            updated_by_script=_UPDATED_BY_SCRIPT,
+                        )
+                    wfp_rainfall.set_upload_statuses(statuses)
+                finally:
+                    # Kept for failed runs too as they are the ones to look into
+                    wfp_rainfall.save_report()
+                wfp_rainfall.delete_outputs()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""Cache of downloaded files kept between runs, refreshed with conditional
+requests"""
+
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+
+from hdx.utilities.downloader import Download
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadCache:
+    """Keeps downloaded files by URL along with their ETag and Last-Modified
+    headers. A URL that is in the cache is requested with If-None-Match and
+    If-Modified-Since so that an unchanged file is answered with 304 Not
+    Modified and not downloaded again. Files are requested with gzip transfer
+    encoding and stored decompressed.
+
+    When a file is added, the least recently used files are evicted until the
+    total size is at most max_bytes, except for those used in this run which
+    may still be waiting to be processed. The cache may therefore be larger
+    than max_bytes until save is called at the end of the run, which evicts
+    down to max_bytes and writes the index.
+
+    Args:
+        folder: Folder in which to keep files and index
+        max_bytes: Maximum total size of files kept between runs
+    """
+
+    def __init__(self, folder: Path | str, max_bytes: int):
+        self.folder = Path(folder)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # URL to file name, ETag, Last-Modified, size and when last used
+        self._entries: dict[str, dict] = {}
+        self._clock = 0
+        self._run_start = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def index_path(self) -> Path:
+        return self.folder / "index.json"
+
+    def load(self) -> None:
+        """Load the index, dropping entries whose files are missing and
+        deleting files that are not in it, eg. left by a failed download"""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        if self.index_path.exists():
+            with open(self.index_path, encoding="utf-8") as fp:
+                entries = json.load(fp)
+        else:
+            entries = {}
+        self._entries = {
+            url: entry
+            for url, entry in entries.items()
+            if (self.folder / entry["name"]).exists()
+        }
+        names = {entry["name"] for entry in self._entries.values()}
+        for path in self.folder.iterdir():
+            if path.name not in names and path != self.index_path:
+                path.unlink()
+        self._clock = max(
+            (entry["used"] for entry in self._entries.values()), default=0
+        )
+        self._run_start = self._clock + 1
+        logger.info(f"Loaded download cache with {len(self._entries)} files")
+
+    def _use(self, entry: dict) -> None:
+        self._clock += 1
+        entry["used"] = self._clock
+
+    def download(self, downloader: Download, url: str) -> tuple[Path, bool]:
+        """Get the file at a URL from the cache if it is unchanged or else
+        download it into the cache
+
+        Args:
+            downloader: Download object
+            url: URL to download
+
+        Returns:
+            Path of file and whether it was unchanged
+        """
+        headers = {"Accept-Encoding": "gzip"}
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                # Marked as used first so that it cannot be evicted meanwhile
+                self._use(entry)
+                if entry["etag"]:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    headers["If-Modified-Since"] = entry["last_modified"]
+        downloader.setup(url, stream=True, headers=headers)
+        if entry and downloader.get_status() == 304:
+            downloader.close_response()
+            with self._lock:
+                self.hits += 1
+            return self.folder / entry["name"], True
+        name = f"{hashlib.md5(url.encode('utf-8')).hexdigest()}.csv"
+        path = self.folder / name
+        temp_path = path.with_suffix(".part")
+        downloader.stream_path(temp_path, f"Download of {url} failed!")
+        temp_path.replace(path)
+        with self._lock:
+            entry = {
+                "name": name,
+                "etag": downloader.get_header("ETag") or "",
+                "last_modified": downloader.get_header("Last-Modified") or "",
+                "size": path.stat().st_size,
+            }
+            self._use(entry)
+            self._entries[url] = entry
+            self.misses += 1
+            self._evict(self._run_start)
+        return path, False
+
+    def _evict(self, used_before: int) -> None:
+        """Evict least recently used files last used before used_before until
+        the total size is at most max_bytes"""
+        total = sum(entry["size"] for entry in self._entries.values())
+        for url, entry in sorted(
+            self._entries.items(), key=lambda item: item[1]["used"]
+        ):
+            if total <= self._max_bytes or entry["used"] >= used_before:
+                break
+            (self.folder / entry["name"]).unlink(missing_ok=True)
+            del self._entries[url]
+            total -= entry["size"]
+
+    def save(self) -> None:
+        with self._lock:
+            self._evict(self._clock + 1)
+            temp_path = self.index_path.with_suffix(".tmp")
+            with open(temp_path, "w", encoding="utf-8") as fp:
+                json.dump(self._entries, fp, indent=1)
+            temp_path.replace(self.index_path)
+        logger.info(
+            f"Saved download cache with {len(self._entries)} files "
+            f"({self.hits} unchanged, {self.misses} downloaded)"
+        )
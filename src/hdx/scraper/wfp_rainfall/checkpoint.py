@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""Checkpoint of a run after each country used to resume a failed run"""
+
+import json
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    """Records the state of a run after each country is finished: where each
+    open output file ends and what is needed to carry on, eg. the messages
+    and time period so far. The checkpoint is a JSON lines file, the first
+    line describing the run and each later one a finished country, which is
+    appended and flushed so that the cost of saving it does not grow with the
+    number of countries. A last line cut short by a failure is ignored. A
+    checkpoint is only used if the options and p-code files it was built with
+    are unchanged.
+
+    Args:
+        folder: Folder holding the output files and checkpoint
+        headers: Output headers. A checkpoint with different headers is ignored.
+        options: Options affecting the output. A checkpoint with different
+        options is ignored.
+    """
+
+    def __init__(self, folder: Path | str, headers: list[str], options: dict):
+        self._folder = Path(folder)
+        self._headers = headers
+        self._options = options
+        self._fp = None
+
+    @property
+    def path(self) -> Path:
+        return self._folder / "checkpoint.jsonl"
+
+    def load(self, pcodes_hash: str) -> tuple[dict, list[dict]] | None:
+        """Load the checkpoint of a previous run if it can be resumed
+
+        Args:
+            pcodes_hash: Hash of the p-code files of this run
+
+        Returns:
+            Run details and list of finished countries or None
+        """
+        if not self.path.exists():
+            logger.info("No checkpoint to resume from")
+            return None
+        with open(self.path, encoding="utf-8") as fp:
+            lines = fp.readlines()
+        try:
+            run = json.loads(lines[0])
+        except (IndexError, json.JSONDecodeError):
+            logger.info("Ignoring unreadable checkpoint")
+            return None
+        if run.get("version") != _CHECKPOINT_VERSION:
+            logger.info("Ignoring checkpoint with a different version")
+            return None
+        if run.get("headers") != self._headers:
+            logger.info("Ignoring checkpoint with different headers")
+            return None
+        if run.get("options") != self._options:
+            logger.info("Ignoring checkpoint with different options")
+            return None
+        if run.get("pcodes_hash") != pcodes_hash:
+            logger.info("Ignoring checkpoint built with different p-codes")
+            return None
+        countries = []
+        for line in lines[1:]:
+            try:
+                countries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+        logger.info(f"Resuming from checkpoint with {len(countries)} countries")
+        return run, countries
+
+    def start(self, today: str, pcodes_hash: str) -> None:
+        """Start a new checkpoint, discarding any existing one"""
+        self.close()
+        self._folder.mkdir(parents=True, exist_ok=True)
+        self._fp = open(self.path, "w", encoding="utf-8")
+        self._write(
+            {
+                "version": _CHECKPOINT_VERSION,
+                "headers": self._headers,
+                "options": self._options,
+                "pcodes_hash": pcodes_hash,
+                "today": today,
+            }
+        )
+
+    def resume(self, no_countries: int) -> None:
+        """Carry on appending to a loaded checkpoint after the first
+        no_countries countries, dropping any line cut short by a failure"""
+        self.close()
+        with open(self.path, encoding="utf-8") as fp:
+            lines = fp.readlines()[: no_countries + 1]
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as fp:
+            fp.writelines(lines)
+        temp_path.replace(self.path)
+        self._fp = open(self.path, "a", encoding="utf-8")
+
+    def add_country(self, country: dict) -> None:
+        self._write(country)
+
+    def _write(self, line: dict) -> None:
+        self._fp.write(f"{json.dumps(line)}\n")
+        self._fp.flush()
+
+    def close(self) -> None:
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    def delete(self) -> None:
+        self.close()
+        self.path.unlink(missing_ok=True)
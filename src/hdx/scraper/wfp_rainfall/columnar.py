@@ -0,0 +1,475 @@
+#!/usr/bin/python
+"""Columnar transform of a country's 5ytd rainfall file into HAPI rows using
+NumPy. The file is read in chunks of whole lines. The lines of a chunk that
+would be discarded by prefilter_rows are found from the positions of its
+newlines and commas, so they are never split into values. The output rows of
+the lines kept are built from the formatted values of each distinct date,
+p-code, version and number of pixels and written as CSV text. It writes the
+same rows, in the same order, as the row by row transform in Pipeline."""
+
+import csv
+from codecs import BOM_UTF8
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from io import StringIO
+from itertools import chain, islice
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from hdx.scraper.wfp_rainfall.constants import AGGREGATION_PERIODS, VERSIONS
+from hdx.scraper.wfp_rainfall.dekads import DekadTable
+from hdx.scraper.wfp_rainfall.pcodes import PcodeIndex
+from hdx.scraper.wfp_rainfall.reader import prefilter_rows
+from hdx.scraper.wfp_rainfall.writer import RowWriter
+
+_NEWLINE = ord("\n")
+_CARRIAGE_RETURN = ord("\r")
+_COMMA = ord(",")
+_DASH = ord("-")
+_TWO = ord("2")
+
+
+class ColumnarResult(NamedTuple):
+    dates: set[str]
+    kept_dates: set[str]
+    messages: Counter[tuple[str, str]]
+
+
+def _iter_chunks(path: Path | str | Iterable[str], chunk_size: int) -> Iterator[bytes]:
+    """Get a rainfall file, or the lines streamed from it, as UTF-8 chunks of
+    about chunk_size bytes that end at the end of a line"""
+    if isinstance(path, (Path, str)):
+        with open(path, "rb") as fp:
+            chunk = fp.read(chunk_size) + fp.readline()
+            yield chunk.removeprefix(BOM_UTF8)
+            while chunk := fp.read(chunk_size):
+                yield chunk + fp.readline()
+        return
+    lines = []
+    size = 0
+    for line in path:
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(lines).encode("utf-8")
+            lines = []
+            size = 0
+    if lines:
+        yield "".join(lines).encode("utf-8")
+
+
+def _to_values(rows: Sequence[Sequence[str]], no_headers: int) -> np.ndarray:
+    values = np.empty((len(rows), no_headers), dtype=object)
+    if rows:
+        values[:] = rows
+    return values
+
+
+def _read_chunk(
+    chunk: bytes,
+    no_headers: int,
+    date_index: int,
+    level_index: int | None,
+    cutoff: str,
+    exclude_admin2: bool,
+    dates: set[str],
+) -> tuple[np.ndarray, int]:
+    """Get the values of the lines of a chunk with no quotes that pass
+    prefilter_rows and the number of lines that are not empty"""
+    # Raises UnicodeDecodeError as reading the file as text would
+    chunk.decode("utf-8")
+    data = np.frombuffer(chunk, np.uint8)
+    ends = np.flatnonzero(data == _NEWLINE)
+    if chunk[-1:] != b"\n":
+        ends = np.append(ends, len(chunk))
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    ends -= (ends > starts) & (data[np.maximum(ends - 1, 0)] == _CARRIAGE_RETURN)
+    # Sentinel after the last line so that every line has a following comma
+    commas = np.append(np.flatnonzero(data == _COMMA), len(chunk) + 1)
+    first_comma = np.searchsorted(commas, starts)
+    no_commas = np.searchsorted(commas, ends) - first_comma
+    # Lines with no values are skipped and not counted, as in prefilter_rows
+    not_empty = ends - starts > no_commas
+    starts = starts[not_empty]
+    ends = ends[not_empty]
+    first_comma = first_comma[not_empty]
+    no_commas = no_commas[not_empty]
+    no_lines = len(starts)
+
+    def get_bounds(index: int) -> tuple[np.ndarray, np.ndarray]:
+        """Start and end of a value in each line, empty in lines without it"""
+        if index:
+            start = commas[np.minimum(first_comma + index - 1, len(commas) - 1)] + 1
+            start = np.where(no_commas >= index, start, ends)
+        else:
+            start = starts
+        end = commas[np.minimum(first_comma + index, len(commas) - 1)]
+        return start, np.where(no_commas > index, end, ends)
+
+    date_starts, date_ends = get_bounds(date_index)
+    # Dates are compared as bytes, which sort as their characters do
+    is_iso = date_ends - date_starts == 10
+    iso_starts = date_starts[is_iso]
+    iso_bytes = data[iso_starts[:, np.newaxis] + np.arange(10)]
+    iso_dates = iso_bytes.view("S10").ravel()
+    dates.update(date.decode("utf-8") for date in np.unique(iso_dates).tolist())
+    for start, end in zip(
+        date_starts[~is_iso].tolist(), date_ends[~is_iso].tolist(), strict=True
+    ):
+        dates.add(chunk[start:end].decode("utf-8"))
+    if level_index is None:
+        skip = np.full(no_lines, True)
+    else:
+        level_starts, level_ends = get_bounds(level_index)
+        skip = (level_ends - level_starts == 1) & (
+            data[np.minimum(level_starts, len(data) - 1)] == _TWO
+        )
+    if not exclude_admin2:
+        old = np.full(no_lines, False)
+        old[is_iso] = (
+            (iso_bytes < 128).all(axis=1)
+            & (data[iso_starts + 4] == _DASH)
+            & (iso_dates < cutoff.encode("utf-8"))
+        )
+        skip &= old
+    kept = np.flatnonzero(~skip)
+    if not len(kept):
+        return _to_values([], no_headers), no_lines
+    lines = [
+        chunk[start:end]
+        for start, end in zip(starts[kept].tolist(), ends[kept].tolist(), strict=True)
+    ]
+    if (no_commas[kept] == no_headers - 1).all():
+        values = b",".join(lines).decode("utf-8").split(",")
+        return np.array(values, dtype=object).reshape(len(lines), no_headers), no_lines
+    rows = []
+    for line in lines:
+        row = line.decode("utf-8").split(",")
+        if len(row) < no_headers:
+            row.extend([""] * (no_headers - len(row)))
+        rows.append(row[:no_headers])
+    return _to_values(rows, no_headers), no_lines
+
+
+def read_columns(
+    path: Path | str | Iterable[str],
+    dates: set[str],
+    cutoff: str,
+    exclude_admin2: bool,
+    counts: dict[str, int] | None = None,
+    chunk_size: int = 1048576,
+) -> tuple[list[str], Iterator[np.ndarray]]:
+    """Read the headers of a rainfall file and return an iterator over 2D
+    object arrays of the rows that pass prefilter_rows, one per chunk of the
+    file. Once a quote is found, the rest of the file is read by
+    prefilter_rows as quoted values can span several lines and chunks.
+
+    Args:
+        path: Path to rainfall file or its lines
+        dates: Set to which the date of every row is added
+        cutoff: ISO date before which admin 2 rows are skipped
+        exclude_admin2: Whether to skip all admin 2 rows
+        counts: Dictionary in which to put number of rows read. Defaults to None.
+        chunk_size: Size in bytes of each chunk. Defaults to 1048576.
+
+    Returns:
+        Tuple of (headers, iterator over arrays of values)
+    """
+    chunks = _iter_chunks(path, chunk_size)
+    first = next(chunks, b"")
+    header_end = first.find(b"\n") + 1 or len(first)
+    header_line = first[:header_end].decode("utf-8")
+    headers = next(csv.reader([header_line]), [])
+    no_headers = len(headers)
+    date_index = headers.index("date")
+    level_index = headers.index("adm_level") if "adm_level" in headers else None
+
+    def values() -> Iterator[np.ndarray]:
+        no_rows = 0
+        rest = chain([first[header_end:]], chunks)
+        for chunk in rest:
+            if not chunk:
+                continue
+            if b'"' in chunk or chunk.count(b"\r") != chunk.count(b"\r\n"):
+                break
+            chunk_values, no_lines = _read_chunk(
+                chunk,
+                no_headers,
+                date_index,
+                level_index,
+                cutoff,
+                exclude_admin2,
+                dates,
+            )
+            no_rows += no_lines
+            if len(chunk_values):
+                yield chunk_values
+        else:
+            if counts is not None:
+                counts["read"] = no_rows
+            return
+        lines = chain.from_iterable(
+            StringIO(chunk.decode("utf-8"), newline="")
+            for chunk in chain([chunk], rest)
+        )
+        rest_counts = {}
+        _, rows = prefilter_rows(
+            chain([header_line], lines), dates, cutoff, exclude_admin2, rest_counts
+        )
+        while batch := list(islice(rows, 10000)):
+            yield _to_values(batch, no_headers)
+        if counts is not None:
+            counts["read"] = no_rows + rest_counts["read"]
+
+    return headers, values()
+
+
+def _format(value: str | int | None) -> str:
+    """Format a value as the CSV writer of the row transform would"""
+    if value is None or value == "":
+        # A row of only an empty value would be quoted
+        return ""
+    text = StringIO()
+    csv.writer(text).writerow([value])
+    return text.getvalue().removesuffix("\r\n")
+
+
+def _unique(values: np.ndarray) -> tuple[list, np.ndarray]:
+    """Get the distinct values and the index of each value among them"""
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    return unique_values.tolist(), inverse.ravel()
+
+
+def _spread(results: list, inverse: np.ndarray) -> np.ndarray:
+    """Spread results for distinct values to every value"""
+    array = np.empty(len(results), dtype=object)
+    array[:] = results
+    return array[inverse]
+
+
+def transform_columnar(
+    path: Path | str | Iterable[str],
+    countryiso3: str,
+    hrp: str,
+    gho: str,
+    dataset_id: str,
+    resource_id: str,
+    headers: Sequence[str],
+    get_writer: Callable[[int], RowWriter],
+    dekad_table: DekadTable,
+    pcode_index: PcodeIndex,
+    cutoff: str,
+    counts: dict[str, int] | None = None,
+    history: bool = False,
+    chunk_size: int = 1048576,
+) -> ColumnarResult:
+    """Transform a country's 5ytd rainfall file into HAPI rows and write them
+
+    Args:
+        path: Path to 5ytd rainfall file or its lines
+        countryiso3: Country iso3
+        hrp: Y if country has an HRP, N if not
+        gho: Y if country is in the GHO, N if not
+        dataset_id: HDX id of source dataset
+        resource_id: HDX id of source resource
+        headers: Headers of output files
+        get_writer: Function getting the writer of a year-to-date period
+        dekad_table: Lookup of dekad dates
+        pcode_index: Lookup of p-codes
+        cutoff: ISO date before which admin 2 rows can be skipped when reading
+        counts: Dictionary in which to put number of rows read. Defaults to None.
+        history: Keep admin 2 rows of every year. Defaults to False.
+        chunk_size: Size in bytes of each chunk read. Defaults to 1048576.
+
+    Returns:
+        Source dates, kept dates and messages
+    """
+    exclude_admin2 = countryiso3 == "BRA" or (hrp == "N" and gho == "N")
+    dates = set()
+    kept_dates = set()
+    messages = Counter()
+    file_headers, chunks = read_columns(
+        path, dates, cutoff, exclude_admin2, counts, chunk_size
+    )
+    non_null_headers = [header for header in file_headers if header]
+    if "#" in non_null_headers[0]:
+        # The row transform skips every row of a file whose first header is
+        # an HXL hashtag
+        for _ in chunks:
+            pass
+        return ColumnarResult(dates, kept_dates, messages)
+    columns = {header: i for i, header in enumerate(file_headers)}
+    pcode_column = columns["PCODE" if "PCODE" in columns else "ADM2_PCODE"]
+    wfp_id_column = columns["adm_id" if "adm_id" in columns else "adm2_id"]
+    period_columns = [
+        [columns[f"r{agg_header}{suffix}"] for agg_header in AGGREGATION_PERIODS]
+        for suffix in ("h", "h_avg", "q")
+    ]
+    no_periods = len(AGGREGATION_PERIODS)
+    constants = {
+        "location_code": _format(countryiso3),
+        "has_hrp": _format(hrp),
+        "in_gho": _format(gho),
+        "provider_admin1_name": "Not provided",
+        "aggregation_period": np.array(
+            [[_format(period) for period in AGGREGATION_PERIODS.values()]],
+            dtype=object,
+        ),
+        "dataset_hdx_id": _format(dataset_id),
+        "resource_hdx_id": _format(resource_id),
+    }
+    # Formatted values of each admin level and p-code and of each version
+    resolutions = {}
+    versions = {}
+
+    for values in chunks:
+        if "adm_level" in columns:
+            unique_levels, level_inverse = _unique(values[:, columns["adm_level"]])
+            admin_levels = np.array([int(x) for x in unique_levels])[level_inverse]
+        else:
+            admin_levels = np.full(len(values), 2)
+        unique_dates, date_inverse = _unique(values[:, columns["date"]])
+        dekad_dates = [dekad_table.get(date) for date in unique_dates]
+        ytds = np.array([x.ytd for x in dekad_dates])[date_inverse]
+        mask = np.full(len(values), True)
+        if not history:
+            mask &= (ytds <= 1) | (admin_levels <= 1)
+        if exclude_admin2:
+            mask &= admin_levels != 2
+        if not mask.all():
+            values = values[mask]
+            admin_levels = admin_levels[mask]
+            date_inverse = date_inverse[mask]
+            ytds = ytds[mask]
+        no_rows = len(values)
+        if not no_rows:
+            continue
+        kept_dates.update(unique_dates[i] for i in np.unique(date_inverse).tolist())
+        is_admin1 = admin_levels == 1
+
+        # Each distinct admin level and p-code is resolved once per country
+        unique_pcodes, pcode_inverse = _unique(values[:, pcode_column])
+        keys = np.where(is_admin1, 0, len(unique_pcodes)) + pcode_inverse
+        unique_keys, key_inverse, key_counts = np.unique(
+            keys, return_inverse=True, return_counts=True
+        )
+        key_resolutions = []
+        for key, count in zip(unique_keys.tolist(), key_counts.tolist(), strict=True):
+            level, pcode = divmod(key, len(unique_pcodes))
+            level_pcode = (level + 1, unique_pcodes[pcode])
+            resolution = resolutions.get(level_pcode)
+            if resolution is None:
+                adm_codes, adm_names, warnings = pcode_index.resolve(
+                    countryiso3, level + 1, unique_pcodes[pcode] or None
+                )
+                resolution = (
+                    *(_format(value) for value in (*adm_codes, *adm_names)),
+                    _format("|".join(warnings)),
+                    warnings,
+                )
+                resolutions[level_pcode] = resolution
+            for warning in resolution[5]:
+                messages[(warning, "warning")] += count * no_periods
+            key_resolutions.append(resolution)
+        key_inverse = key_inverse.ravel()
+
+        unique_versions, version_inverse, version_counts = np.unique(
+            values[:, columns["version"]], return_inverse=True, return_counts=True
+        )
+        row_versions = []
+        for raw_version, count in zip(
+            unique_versions.tolist(), version_counts.tolist(), strict=True
+        ):
+            version = versions.get(raw_version)
+            if version is None:
+                mapped_version = VERSIONS.get(raw_version)
+                if mapped_version:
+                    error = ""
+                    version = (mapped_version, "", "Missing rainfall value")
+                else:
+                    error = f"Version unknown {raw_version or None}"
+                    version = (
+                        "",
+                        _format(error),
+                        _format(f"{error}|Missing rainfall value"),
+                    )
+                versions[raw_version] = version
+            if version[1]:
+                error = f"Version unknown {raw_version or None}"
+                messages[(error, "error")] += count * no_periods
+            row_versions.append(version)
+        version_inverse = version_inverse.ravel()
+        errors = _spread([version[1] for version in row_versions], version_inverse)
+        missing_errors = _spread(
+            [version[2] for version in row_versions], version_inverse
+        )
+
+        unique_pixels, pixel_inverse = _unique(values[:, columns["n_pixels"]])
+        wfp_ids = values[:, wfp_id_column]
+        wfp_ids = np.where(wfp_ids == "", "None", wfp_ids)
+        period_values = [values[:, indices] for indices in period_columns]
+        missing = (
+            (period_values[0] == "")
+            | (period_values[1] == "")
+            | (period_values[2] == "")
+        )
+        row_columns = {
+            "provider_admin2_name": np.where(is_admin1, "", "Not provided"),
+            "admin_level": np.where(is_admin1, "1", admin_levels.astype(str)),
+            "provider_admin1_code": np.where(is_admin1, wfp_ids, ""),
+            "provider_admin2_code": np.where(is_admin1, "", wfp_ids),
+            "rainfall": period_values[0],
+            "rainfall_long_term_average": period_values[1],
+            "rainfall_anomaly_pct": period_values[2],
+            "number_pixels": _spread(
+                [str(int(float(x))) for x in unique_pixels], pixel_inverse
+            ),
+            "version": _spread(
+                [version[0] for version in row_versions], version_inverse
+            ),
+            "reference_period_start": _spread(
+                [x.start_date_iso for x in dekad_dates], date_inverse
+            ),
+            "reference_period_end": _spread(
+                [x.end_date_iso for x in dekad_dates], date_inverse
+            ),
+            "error": np.where(
+                missing, missing_errors[:, np.newaxis], errors[:, np.newaxis]
+            ),
+        }
+        for i, header in enumerate(
+            ("admin1_code", "admin2_code", "admin1_name", "admin2_name", "warning")
+        ):
+            row_columns[header] = _spread(
+                [resolution[i] for resolution in key_resolutions], key_inverse
+            )
+
+        # Each output line is made of pieces: the values of its row or of its
+        # row and aggregation period and the constant text between them
+        pieces = []
+        text = ""
+        for i, header in enumerate(headers):
+            if i:
+                text += ","
+            value = constants.get(header, row_columns.get(header, ""))
+            if isinstance(value, str):
+                text += value
+                continue
+            if text:
+                pieces.append(text)
+            pieces.append(value[:, np.newaxis] if value.ndim == 1 else value)
+            text = ""
+        pieces.append(f"{text}\r\n")
+        lines = np.empty((no_rows, no_periods, len(pieces)), dtype=object)
+        for i, piece in enumerate(pieces):
+            lines[:, :, i] = piece
+        for ytd in np.unique(ytds).tolist():
+            ytd_lines = lines[ytds == ytd]
+            get_writer(ytd).write_formatted(
+                "".join(ytd_lines.ravel().tolist()), len(ytd_lines) * no_periods
+            )
+    return ColumnarResult(dates, kept_dates, messages)
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+"""Constants shared by the row and columnar transforms"""
+
+AGGREGATION_PERIODS = {
+    "f": "dekad",
+    "1": "1-month",
+    "3": "3-month",
+}
+VERSIONS = {
+    "final": "final",
+    "forecast": "forecast",
+    "prelim": "preliminary",
+}
+# Order of values in the rows written by the transforms
+HAPI_FIELDS = (
+    "location_code",
+    "has_hrp",
+    "in_gho",
+    "provider_admin1_name",
+    "provider_admin2_name",
+    "admin1_code",
+    "admin1_name",
+    "admin2_code",
+    "admin2_name",
+    "admin_level",
+    "provider_admin1_code",
+    "provider_admin2_code",
+    "aggregation_period",
+    "rainfall",
+    "rainfall_long_term_average",
+    "rainfall_anomaly_pct",
+    "number_pixels",
+    "version",
+    "reference_period_start",
+    "reference_period_end",
+    "dataset_hdx_id",
+    "resource_hdx_id",
+    "warning",
+    "error",
+)
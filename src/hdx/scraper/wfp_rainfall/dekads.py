@@ -0,0 +1,62 @@
+#!/usr/bin/python
+"""Lookup of dekad dates shared by all countries in a run"""
+
+from datetime import datetime, timedelta
+from math import ceil
+from typing import NamedTuple
+
+from hdx.utilities.dateparse import iso_string_from_datetime, parse_date
+from kalendar import Dekad
+
+
+class DekadDates(NamedTuple):
+    start_date: datetime
+    end_date: datetime
+    start_date_iso: str
+    end_date_iso: str
+    ytd: int
+
+
+def get_ytd(start_date: datetime, today: datetime) -> int:
+    """Get number of years ago (rounded up) of a date relative to today
+
+    Args:
+        start_date: Start date of dekad
+        today: Date of run
+
+    Returns:
+        Year-to-date period
+    """
+    return ceil((today - start_date).days / 365)
+
+
+class DekadTable:
+    """Start and end dates, ISO strings and year-to-date period of each dekad
+    keyed by the date string in the source data. There are only a few hundred
+    distinct dates across all countries so each is parsed once per run.
+
+    Args:
+        today: Date of run
+    """
+
+    def __init__(self, today: datetime):
+        self._today = today
+        self._dates: dict[str, DekadDates] = {}
+
+    def get(self, date: str) -> DekadDates:
+        dekad_dates = self._dates.get(date)
+        if dekad_dates:
+            return dekad_dates
+        start_date = parse_date(date)
+        dekad = Dekad.fromdatetime(start_date)
+        end_date = (dekad + 1).todate() - timedelta(days=1)
+        end_date = parse_date(str(end_date))
+        dekad_dates = DekadDates(
+            start_date,
+            end_date,
+            iso_string_from_datetime(start_date),
+            iso_string_from_datetime(end_date),
+            get_ytd(start_date, self._today),
+        )
+        self._dates[date] = dekad_dates
+        return dekad_dates
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+"""Counted warnings and errors passed to the error handler once per country"""
+
+from collections import Counter
+from collections.abc import Mapping
+
+from hdx.api.utilities.hdx_error_handler import HDXErrorHandler
+
+
+class Diagnostics:
+    """Counts the warnings and errors of the country being processed so that
+    transforms can add a message for every output row it applies to without
+    calling the error handler. When the country is flushed, each unique
+    message is passed to the error handler once with its count and added to
+    the run totals by category, dataset and message.
+
+    Args:
+        error_handler: HDX error handler. None in worker processes which only
+        count.
+        category: Category of messages. Defaults to "Rainfall".
+    """
+
+    def __init__(
+        self, error_handler: HDXErrorHandler | None, category: str = "Rainfall"
+    ):
+        self._error_handler = error_handler
+        self._category = category
+        # (text, message type) to count for the current country
+        self.counts: Counter[tuple[str, str]] = Counter()
+        # (category, dataset, text, message type) to count for the run
+        self.totals: Counter[tuple[str, str, str, str]] = Counter()
+
+    def add(self, text: str, message_type: str = "error", count: int = 1) -> None:
+        self.counts[(text, message_type)] += count
+
+    def update(self, counts: Mapping[tuple[str, str], int]) -> None:
+        self.counts.update(counts)
+
+    def reset(self) -> None:
+        self.counts = Counter()
+
+    @staticmethod
+    def summarise(text: str, count: int) -> str:
+        if count == 1:
+            return text
+        return f"{text} ({count} rows)"
+
+    def flush(self, dataset_name: str) -> list[list[str | int]]:
+        """Pass each unique message of the current country to the error
+        handler and add its count to the run totals
+
+        Args:
+            dataset_name: Name of the country's dataset
+
+        Returns:
+            Sorted list of text, message type and count of messages flushed
+        """
+        messages = []
+        for (text, message_type), count in sorted(self.counts.items()):
+            self._error_handler.add_message(
+                self._category,
+                dataset_name,
+                self.summarise(text, count),
+                message_type=message_type,
+            )
+            self.totals[(self._category, dataset_name, text, message_type)] += count
+            messages.append([text, message_type, count])
+        self.reset()
+        return messages
+
+    def get_messages(self, dataset_name: str) -> list[list[str | int]]:
+        """Get the text, message type and count of the run totals of a
+        dataset in the form returned by flush"""
+        return sorted(
+            [text, message_type, count]
+            for (_, name, text, message_type), count in self.totals.items()
+            if name == dataset_name
+        )
+
+    def get_summary(self) -> list[dict[str, str | int]]:
+        """Get the run totals, most frequent first"""
+        return [
+            {
+                "category": category,
+                "dataset": dataset_name,
+                "message": text,
+                "message_type": message_type,
+                "count": count,
+            }
+            for (category, dataset_name, text, message_type), count in sorted(
+                self.totals.items(), key=lambda item: (-item[1], item[0])
+            )
+        ]
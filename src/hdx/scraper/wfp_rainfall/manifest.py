@@ -0,0 +1,104 @@
+#!/usr/bin/python
+"""Manifest of the previous run used to reuse unchanged countries"""
+
+import json
+import logging
+import sys
+from datetime import datetime
+from pathlib import Path
+from shutil import copyfile
+
+from hdx.utilities.file_hashing import get_size_and_hash
+
+logger = logging.getLogger(__name__)
+
+_MANIFEST_VERSION = 3
+
+
+class Manifest:
+    """Records, for each country, the source resource it was built from and
+    where its transformed rows sit in each of the output files. The output
+    files are copied alongside the manifest so that the rows can be copied
+    into the next run's output without downloading the source again. A
+    manifest is only used if the p-code files it was built with are unchanged
+    and the copied outputs have the size and MD5 hash it records, so that
+    outputs left part copied by a run that failed while saving are not used.
+
+    Args:
+        folder: Folder in which to persist the manifest and previous outputs
+        headers: Output headers. A manifest with different headers is ignored.
+        today: Date of this run
+    """
+
+    def __init__(self, folder: Path | str, headers: list[str], today: datetime):
+        self._folder = Path(folder)
+        self._headers = headers
+        self._today = today
+        self.previous_today: datetime | None = None
+        self.previous: dict[str, dict] = {}
+        self.countries: dict[str, dict] = {}
+
+    @property
+    def path(self) -> Path:
+        return self._folder / "manifest.json"
+
+    def get_previous_output(self, ytd: int) -> Path:
+        return self._folder / "previous" / f"hdx_hapi_rainfall_global_{ytd}yr.csv"
+
+    def load(self, pcodes_hash: str) -> None:
+        if not self.path.exists():
+            logger.info("No manifest from a previous run")
+            return
+        with open(self.path, encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        if manifest.get("version") != _MANIFEST_VERSION:
+            logger.info("Ignoring manifest with a different version")
+            return
+        if manifest.get("headers") != self._headers:
+            logger.info("Ignoring manifest with different headers")
+            return
+        if manifest.get("pcodes_hash") != pcodes_hash:
+            logger.info("Ignoring manifest built with different p-codes")
+            return
+        if not self._check_outputs(manifest["outputs"]):
+            logger.info("Ignoring manifest whose previous outputs do not match")
+            return
+        self.previous_today = datetime.fromisoformat(manifest["today"])
+        self.previous = manifest["countries"]
+        # Dates repeat across countries so are kept only once
+        for record in self.previous.values():
+            record["dates"] = [sys.intern(date) for date in record["dates"]]
+        logger.info(f"Loaded manifest with {len(self.previous)} countries")
+
+    def _check_outputs(self, outputs: dict[str, list]) -> bool:
+        for ytd, size_and_hash in outputs.items():
+            path = self.get_previous_output(int(ytd))
+            if not path.exists():
+                return False
+            if list(get_size_and_hash(path, "csv")) != size_and_hash:
+                return False
+        return True
+
+    def save(self, outputs: dict[int, Path], pcodes_hash: str) -> None:
+        folder = self._folder / "previous"
+        folder.mkdir(parents=True, exist_ok=True)
+        for path in folder.glob("*.csv"):
+            path.unlink()
+        sizes_and_hashes = {}
+        for ytd, path in outputs.items():
+            previous_output = self.get_previous_output(ytd)
+            copyfile(path, previous_output)
+            sizes_and_hashes[ytd] = get_size_and_hash(previous_output, "csv")
+        manifest = {
+            "version": _MANIFEST_VERSION,
+            "headers": self._headers,
+            "pcodes_hash": pcodes_hash,
+            "today": self._today.isoformat(),
+            "outputs": sizes_and_hashes,
+            "countries": self.countries,
+        }
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, indent=1)
+        temp_path.replace(self.path)
+        logger.info(f"Saved manifest with {len(self.countries)} countries")
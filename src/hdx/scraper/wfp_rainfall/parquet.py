@@ -0,0 +1,88 @@
+#!/usr/bin/python
+"""Parquet copies of the output CSV files using pyarrow. Needs the parquet
+extra."""
+
+from collections.abc import Sequence
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+# Types of output columns that are not strings
+_COLUMN_TYPES = {
+    "admin_level": pa.int8(),
+    "rainfall": pa.float64(),
+    "rainfall_long_term_average": pa.float64(),
+    "rainfall_anomaly_pct": pa.float64(),
+    "number_pixels": pa.int64(),
+}
+_SORT_KEYS = [
+    ("location_code", "ascending"),
+    ("reference_period_start", "ascending"),
+]
+
+
+def write_parquet(
+    csv_path: Path | str,
+    parquet_path: Path | str,
+    headers: Sequence[str],
+    row_group_rows: int = 250000,
+    compression: str = "zstd",
+) -> int:
+    """Write a Parquet copy of an output CSV file. The CSV file is read in
+    blocks which are collected into row groups of row_group_rows so memory use
+    does not depend on the size of the file. The rows of each row group are
+    sorted by location and date, which keeps values that repeat together, and
+    string columns are dictionary encoded. Empty numbers are nulls and empty
+    strings are kept as empty strings like in the CSV.
+
+    Args:
+        csv_path: Path of output CSV file
+        parquet_path: Path of Parquet file
+        headers: Headers of output CSV file
+        row_group_rows: Number of rows in each row group. Defaults to 250000.
+        compression: Parquet compression codec. Defaults to "zstd".
+
+    Returns:
+        Number of rows written
+    """
+    schema = pa.schema(
+        [(header, _COLUMN_TYPES.get(header, pa.string())) for header in headers]
+    )
+    string_columns = [header for header in headers if header not in _COLUMN_TYPES]
+    reader = pv.open_csv(
+        csv_path,
+        read_options=pv.ReadOptions(block_size=16777216),
+        convert_options=pv.ConvertOptions(column_types=schema),
+    )
+    no_rows = 0
+    with pq.ParquetWriter(
+        parquet_path,
+        schema,
+        compression=compression,
+        use_dictionary=string_columns,
+    ) as writer:
+
+        def write_row_group(batches: list[pa.RecordBatch]) -> None:
+            table = pa.Table.from_batches(batches, schema)
+            writer.write_table(table.sort_by(_SORT_KEYS), row_group_size=len(table))
+
+        batches = []
+        batch_rows = 0
+        for batch in reader:
+            while batch_rows + len(batch) >= row_group_rows:
+                split = row_group_rows - batch_rows
+                batches.append(batch.slice(0, split))
+                write_row_group(batches)
+                no_rows += row_group_rows
+                batch = batch.slice(split)
+                batches = []
+                batch_rows = 0
+            if len(batch):
+                batches.append(batch)
+                batch_rows += len(batch)
+        if batch_rows:
+            write_row_group(batches)
+            no_rows += batch_rows
+    return no_rows
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+"""Persistent index of admin 1 and 2 p-codes"""
+
+import hashlib
+import logging
+import pickle
+from copy import copy
+from pathlib import Path
+from time import perf_counter
+
+from hdx.location.adminlevel import AdminLevel
+from hdx.pipelineutils.hapi_admins import complete_admins
+from hdx.utilities.downloader import Download
+from hdx.utilities.retriever import Retrieve
+
+logger = logging.getLogger(__name__)
+
+_INDEX_VERSION = 1
+
+# admin codes, admin names, warnings
+Resolution = tuple[tuple[str, str], tuple[str, str], tuple[str, ...]]
+
+
+class PcodeIndex:
+    """Resolves WFP p-codes to HAPI admin 1 and 2 codes and names.
+
+    The index is compiled from the global p-codes and p-code lengths files and
+    pickled in folder together with every other p-code resolved, keyed on the
+    hash of those files. Later runs with unchanged files load the pickle rather
+    than setting up AdminLevel objects which are only created if a p-code is
+    not in the index.
+
+    The index can be pickled to worker processes which use it read only. Any
+    AdminLevel objects set up, eg. with setup_admins, are pickled with it
+    (without their retriever) so that workers do not each set them up. The
+    p-codes workers resolve are passed back with pop_new_resolved and merged
+    into the main process's index with add_resolved.
+
+    Args:
+        retriever: Retrieve object used to download the p-code files
+        folder: Folder in which to persist the index. Defaults to None (don't persist).
+    """
+
+    def __init__(self, retriever: Retrieve, folder: Path | str | None = None):
+        self._retriever = retriever
+        self._folder = Path(folder) if folder else None
+        self._admin_path = None
+        self._formats_path = None
+        self._admins: list[AdminLevel] = []
+        self.hash = ""
+        self._index: dict[tuple[int, str], Resolution] = {}
+        self._resolved: dict[tuple[str, int, str], Resolution] = {}
+        # Only tracked in workers which pass them back to the main process
+        self._new_resolved: dict[tuple[str, int, str], Resolution] | None = None
+        self._changed = False
+        # Number of and time taken by lookups that needed complete_admins
+        self.fallbacks = 0
+        self.fallback_seconds = 0.0
+
+    def __getstate__(self) -> dict:
+        # Workers get the lookups and AdminLevel objects but not the downloader
+        state = self.__dict__.copy()
+        state["_retriever"] = None
+        state["_admins"] = []
+        for admin in self._admins:
+            admin = copy(admin)
+            admin._retriever = None
+            state["_admins"].append(admin)
+        state["_new_resolved"] = {}
+        state["fallbacks"] = 0
+        state["fallback_seconds"] = 0.0
+        return state
+
+    def set_retriever(self, retriever: Retrieve) -> None:
+        self._retriever = retriever
+
+    @property
+    def path(self) -> Path | None:
+        if not self._folder:
+            return None
+        return self._folder / "pcode_index.pickle"
+
+    def setup(self) -> None:
+        self._admin_path = self._retriever.download_file(AdminLevel.admin_url)
+        self._formats_path = self._retriever.download_file(AdminLevel.formats_url)
+        sha256 = hashlib.sha256()
+        for path in (self._admin_path, self._formats_path):
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1048576), b""):
+                    sha256.update(chunk)
+        self.hash = sha256.hexdigest()
+        if self._load():
+            return
+        self._compile()
+
+    def _load(self) -> bool:
+        if not self.path or not self.path.exists():
+            return False
+        with open(self.path, "rb") as fp:
+            saved = pickle.load(fp)
+        if saved.get("version") != _INDEX_VERSION or saved.get("hash") != self.hash:
+            logger.info("P-code files have changed since index was saved")
+            return False
+        self._index = saved["index"]
+        self._resolved = saved["resolved"]
+        logger.info(f"Loaded p-code index with {len(self._index)} p-codes")
+        return True
+
+    def _get_admins(self) -> list[AdminLevel]:
+        if self._admins:
+            return self._admins
+        downloader: Download = self._retriever.downloader
+        for admin_level in [1, 2]:
+            admin = AdminLevel(admin_level=admin_level, retriever=self._retriever)
+            _, rows = downloader.get_tabular_rows(self._admin_path, dict_form=True)
+            admin.setup_from_iterable(rows)
+            _, rows = downloader.get_tabular_rows(self._formats_path, dict_form=True)
+            admin.load_pcode_formats_from_iterable(rows)
+            self._admins.append(admin)
+        return self._admins
+
+    def setup_admins(self) -> None:
+        """Set up the AdminLevel objects used for p-codes not in the index if
+        they are not already, eg. before pickling the index to workers"""
+        self._get_admins()
+
+    def _compile(self) -> None:
+        """Build the index of p-codes that are already in normalised form. This
+        gives the same result as complete_admins without its list lookups."""
+        admin1, admin2 = self._get_admins()
+        self._index = {}
+        self._resolved = {}
+        for pcode in admin1.pcodes:
+            self._index[(1, pcode)] = (
+                (pcode, ""),
+                (admin1.pcode_to_name.get(pcode, ""), ""),
+                (),
+            )
+        for pcode in admin2.pcodes:
+            parent = admin2.pcode_to_parent.get(pcode) or ""
+            parent_name = admin1.pcode_to_name.get(parent, "") if parent else ""
+            self._index[(2, pcode)] = (
+                (parent, pcode),
+                (parent_name, admin2.pcode_to_name.get(pcode, "")),
+                (),
+            )
+        self._changed = True
+        logger.info(f"Compiled p-code index with {len(self._index)} p-codes")
+
+    def resolve(self, countryiso3: str, admin_level: int, pcode: str) -> Resolution:
+        """Get admin codes, names and any warnings for a WFP p-code
+
+        Args:
+            countryiso3: Country of p-code
+            admin_level: Admin level of p-code (1 or 2)
+            pcode: WFP p-code
+
+        Returns:
+            Tuple of (admin 1 and 2 codes, admin 1 and 2 names, warnings)
+        """
+        resolution = self._index.get((admin_level, pcode))
+        if resolution:
+            return resolution
+        key = (countryiso3, admin_level, pcode)
+        resolution = self._resolved.get(key)
+        if resolution:
+            return resolution
+        start = perf_counter()
+        if admin_level == 1:
+            adm_codes = [pcode, ""]
+        else:
+            adm_codes = ["", pcode]
+        adm_names = ["", ""]
+        try:
+            _, warnings = complete_admins(
+                self._get_admins(),
+                countryiso3,
+                ["", ""],
+                adm_codes,
+                adm_names,
+                fuzzy_match=False,
+            )
+        except IndexError:
+            warnings = [f"Pcode unknown {adm_codes[1]}"]
+            adm_codes = ["", ""]
+        resolution = (tuple(adm_codes), tuple(adm_names), tuple(warnings))
+        self._resolved[key] = resolution
+        if self._new_resolved is not None:
+            self._new_resolved[key] = resolution
+        self._changed = True
+        self.fallbacks += 1
+        self.fallback_seconds += perf_counter() - start
+        return resolution
+
+    def pop_new_resolved(self) -> dict[tuple[str, int, str], Resolution]:
+        """Get the p-codes resolved in a worker since this was last called"""
+        new_resolved = self._new_resolved or {}
+        self._new_resolved = {}
+        return new_resolved
+
+    def add_resolved(self, resolved: dict[tuple[str, int, str], Resolution]) -> None:
+        """Add p-codes resolved elsewhere, eg. in a worker process"""
+        if not resolved:
+            return
+        self._resolved.update(resolved)
+        self._changed = True
+
+    def save(self) -> None:
+        if not self.path or not self._changed:
+            return
+        self._folder.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "wb") as fp:
+            pickle.dump(
+                {
+                    "version": _INDEX_VERSION,
+                    "hash": self.hash,
+                    "index": self._index,
+                    "resolved": self._resolved,
+                },
+                fp,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        temp_path.replace(self.path)
+        self._changed = False
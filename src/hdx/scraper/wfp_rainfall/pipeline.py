@@ -1,37 +1,90 @@
 #!/usr/bin/python
 """wfp-rainfall scraper"""
 
+import asyncio
 import csv
 import logging
-from datetime import datetime, timedelta
-from math import ceil
+import sys
+import threading
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import chain
+from os.path import getsize
 from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import NamedTuple
 
 from hdx.api.configuration import Configuration
 from hdx.api.utilities.hdx_error_handler import HDXErrorHandler
 from hdx.data.dataset import Dataset
 from hdx.data.resource import Resource
-from hdx.location.adminlevel import AdminLevel
 from hdx.location.country import Country
-from hdx.pipelineutils.hapi_admins import complete_admins
-from hdx.utilities.dateparse import iso_string_from_datetime, parse_date
-from hdx.utilities.downloader import DownloadError
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download, DownloadError
 from hdx.utilities.retriever import Retrieve
-from kalendar import Dekad
+
+from hdx.scraper.wfp_rainfall.cache import DownloadCache
+from hdx.scraper.wfp_rainfall.checkpoint import Checkpoint
+from hdx.scraper.wfp_rainfall.constants import (
+    AGGREGATION_PERIODS,
+    HAPI_FIELDS,
+    VERSIONS,
+)
+from hdx.scraper.wfp_rainfall.dekads import DekadTable, get_ytd
+from hdx.scraper.wfp_rainfall.diagnostics import Diagnostics
+from hdx.scraper.wfp_rainfall.manifest import Manifest
+from hdx.scraper.wfp_rainfall.pcodes import PcodeIndex
+from hdx.scraper.wfp_rainfall.reader import get_cutoff, open_lines, prefilter_rows
+from hdx.scraper.wfp_rainfall.report import RunReport
+from hdx.scraper.wfp_rainfall.streaming import LineSplitter, iter_queue
+from hdx.scraper.wfp_rainfall.writer import RowWriter
 
 logger = logging.getLogger(__name__)
 
 
-_AGGREGATION_PERIODS = {
-    "f": "dekad",
-    "1": "1-month",
-    "3": "3-month",
-}
-_VERSIONS = {
-    "final": "final",
-    "forecast": "forecast",
-    "prelim": "preliminary",
+# Formats in which outputs can also be written and their HDX resource formats
+_EXTRA_FORMATS = {
+    "csv.gz": "gz",
+    "parquet": "parquet",
 }
+_DATASET_NAME = "hdx-hapi-rainfall"
+_DATASERIES_NAME = "WFP - Rainfall Indicators at Subnational Level"
+
+
+class _Source(NamedTuple):
+    countryiso3: str
+    dataset_name: str
+    dataset_id: str
+    resource_id: str = ""
+    url: str = ""
+    last_modified: str = ""
+
+
+class _CountryData(NamedTuple):
+    source: _Source
+    path: Path | None = None
+    error: tuple[str, str] | None = None
+    record: dict | None = None
+    # Lines streamed from the country file in asynchronous mode
+    lines: Iterable[str] | None = None
+    # Tasks streaming the country file in asynchronous mode
+    tasks: tuple[asyncio.Task, ...] = ()
+
+
+class _Shard(NamedTuple):
+    folder: str
+    segments: dict[str, tuple[str, int, int]]
+    dates: set[str]
+    kept_dates: set[str]
+    messages: dict[tuple[str, str], int]
+    resolved: dict
+    counts: dict[str, int]
+    stages: dict[str, tuple[float, int]]
 
 
 class Pipeline:
@@ -42,199 +95,1021 @@ class Pipeline:
         temp_dir: str,
         error_handler: HDXErrorHandler,
         today: datetime,
+        state_dir: str | None = None,
+        full_refresh: bool = False,
+        engine: str = "row",
+        processes: int = 1,
+        report: bool = False,
+        history: bool = False,
+        extra_formats: Sequence[str] = (),
+        checkpoint: bool = False,
+        resume: bool = False,
+        cache_dir: str | None = None,
+        asynchronous: bool = False,
+        constant_memory: bool = False,
     ):
         self._configuration = configuration
         self._retriever = retriever
         self._temp_dir = temp_dir
         self._error_handler = error_handler
-        self._today = today
-        self._admins = []
+        self._state_dir = state_dir
+        self._full_refresh = full_refresh
+        if engine not in ("row", "columnar"):
+            raise ValueError(f"Unknown engine {engine}!")
+        self._engine = engine
+        if asynchronous and (processes > 1 or retriever.save):
+            raise ValueError("Asynchronous mode needs one process and no saving!")
+        self._asynchronous = asynchronous
+        if constant_memory and engine == "columnar":
+            raise ValueError("Constant-memory mode needs the row engine!")
+        self._constant_memory = constant_memory
+        self._processes = processes
+        self._history = history
+        for extra_format in extra_formats:
+            if extra_format not in _EXTRA_FORMATS:
+                raise ValueError(f"Unknown format {extra_format}!")
+        self._extra_formats = tuple(extra_formats)
+        self._pcode_index: PcodeIndex | None = None
         self.data: dict[int, Path] = {}
+        # Outputs by year-to-date period, group and part in history mode
+        self.partitions: dict[tuple[int, str, int], Path] = {}
         self.dates: set = set()
-        self._csv_handles: dict = {}
-        self._csv_writers: dict[int, csv.DictWriter] = {}
-
-    def _write_hapi_row(self, ytd: int, hapi_row: dict) -> None:
-        if ytd not in self._csv_handles:
-            filepath = Path(self._temp_dir) / f"hdx_hapi_rainfall_global_{ytd}yr.csv"
-            fh = open(filepath, "w", newline="", encoding="utf-8-sig")
-            writer = csv.DictWriter(
-                fh,
-                fieldnames=self._configuration["headers"],
-                extrasaction="ignore",
+        self._set_today(today)
+        self._group = ""
+        self._parts: dict[tuple[int, str], int] = {}
+        self._writers: dict[int | tuple[int, str], RowWriter] = {}
+        self.unchanged: list[str] = []
+        self._max_workers = configuration["max_workers"]
+        self._sources: dict[str, _Source] = {}
+        self._thread_local = threading.local()
+        self._header_ends: dict[int | tuple[int, str], int] = {}
+        self._diagnostics = Diagnostics(error_handler)
+        self._country_counts: dict[str, int] = {}
+        self.report = RunReport(report)
+        if checkpoint:
+            self._checkpoint = Checkpoint(
+                temp_dir,
+                configuration["headers"],
+                {"history": history, "extra_formats": list(self._extra_formats)},
+            )
+        else:
+            self._checkpoint = None
+        self._resume = resume
+        # Saved data is used as it is so is not cached, nor are streamed files
+        if cache_dir and not (retriever.save or retriever.use_saved or asynchronous):
+            self._download_cache = DownloadCache(
+                cache_dir, configuration["download_cache_max_bytes"]
+            )
+        else:
+            self._download_cache = None
+
+    def _set_today(self, today: datetime) -> None:
+        self._today = today
+        self._dekad_table = DekadTable(today)
+        # Admin 2 rows of every year are kept in history mode
+        self._cutoff = "" if self._history else get_cutoff(today)
+        if self._state_dir and not self._history:
+            self._manifest = Manifest(
+                self._state_dir, self._configuration["headers"], today
+            )
+        else:
+            self._manifest = None
+
+    def _get_writer(self, ytd: int) -> RowWriter:
+        """Get the writer of the output for a year-to-date period or, in
+        history mode, of the current part of the output for a period and the
+        group of the country being processed"""
+        key = (ytd, self._group) if self._group else ytd
+        writer = self._writers.get(key)
+        if writer is None:
+            if self._group:
+                part = self._parts.get(key, 0) + 1
+                self._parts[key] = part
+                group_name = self._group.lower().replace(" ", "-")
+                filepath = (
+                    Path(self._temp_dir)
+                    / f"hdx_hapi_rainfall_{group_name}_{ytd}yr_{part}.csv"
+                )
+                self.partitions[(ytd, self._group, part)] = filepath
+            else:
+                filepath = (
+                    Path(self._temp_dir) / f"hdx_hapi_rainfall_global_{ytd}yr.csv"
+                )
+                self.data[ytd] = filepath
+            writer = self._open_writer(key, filepath)
+        return writer
+
+    def _open_writer(
+        self,
+        key: int | tuple[int, str],
+        filepath: Path,
+        resume_at: int | None = None,
+        header_end: int | None = None,
+    ) -> RowWriter:
+        if "csv.gz" in self._extra_formats:
+            gzip_path = _get_format_path(filepath, "csv.gz")
+        else:
+            gzip_path = None
+        writer = RowWriter(
+            filepath,
+            self._configuration["headers"],
+            HAPI_FIELDS,
+            # Rows are held as formatted text in constant-memory mode
+            buffer_rows=0
+            if self._constant_memory
+            else self._configuration["write_buffer_rows"],
+            chunk_size=self._configuration["write_chunk_size"],
+            gzip_path=gzip_path,
+            resume_at=resume_at,
+        )
+        self._writers[key] = writer
+        self._header_ends[key] = writer.tell() if header_end is None else header_end
+        return writer
+
+    def _get_group(self, countryiso3: str) -> str:
+        country_info = Country.get_country_info_from_iso3(countryiso3) or {}
+        return country_info.get(self._configuration["history_group"]) or "Other"
+
+    def _close_full_parts(self) -> None:
+        """Close outputs that have reached history_target_bytes so that rows
+        of the next country in their group go into a new part. A country's
+        rows for a period are never split across parts, so a part can exceed
+        the target by up to one country's rows."""
+        target_bytes = self._configuration["history_target_bytes"]
+        for key, writer in list(self._writers.items()):
+            if writer.tell() >= target_bytes:
+                self._close_writer(key)
+
+    def _rollback(
+        self, offsets: dict[int, int], rows: dict[int | tuple[int, str], int]
+    ) -> None:
+        """Discard the rows written to the outputs since offsets were taken,
+        closing and deleting any output opened since then"""
+        for key, writer in list(self._writers.items()):
+            if key in offsets:
+                writer.truncate(offsets[key], rows[key])
+                continue
+            del self._writers[key]
+            del self._header_ends[key]
+            writer.close()
+            for path in writer.paths:
+                path.unlink(missing_ok=True)
+            if isinstance(key, tuple):
+                ytd, group = key
+                part = self._parts.pop(key)
+                del self.partitions[(ytd, group, part)]
+                if part > 1:
+                    self._parts[key] = part - 1
+            else:
+                del self.data[key]
+
+    def _close_writer(self, key: int | tuple[int, str]) -> None:
+        writer = self._writers.pop(key)
+        del self._header_ends[key]
+        writer.close()
+
+    def get_outputs(self) -> dict[str, Path]:
+        """Get the output files, including those in extra formats, by name"""
+        if self._history:
+            paths = self.partitions.values()
+        else:
+            paths = self.data.values()
+        outputs = {}
+        for path in paths:
+            outputs[path.name] = path
+            for extra_format in self._extra_formats:
+                format_path = _get_format_path(path, extra_format)
+                outputs[format_path.name] = format_path
+        return outputs
+
+    def _write_parquets(self) -> None:
+        from hdx.scraper.wfp_rainfall.parquet import write_parquet
+
+        paths = self.partitions.values() if self._history else self.data.values()
+        for path in paths:
+            write_parquet(
+                path,
+                _get_format_path(path, "parquet"),
+                self._configuration["headers"],
+                self._configuration["parquet_row_group_rows"],
             )
-            writer.writeheader()
-            self._csv_handles[ytd] = fh
-            self._csv_writers[ytd] = writer
-            self.data[ytd] = filepath
-        clean = {k: ("" if v is None else v) for k, v in hapi_row.items()}
-        self._csv_writers[ytd].writerow(clean)
+
+    def _get_rows_written(self) -> int:
+        return sum(writer.rows for writer in self._writers.values())
+
+    def _get_offsets(self) -> dict[int, int]:
+        return {ytd: writer.tell() for ytd, writer in self._writers.items()}
+
+    def _get_segments(self, offsets: dict[int, int]) -> dict[str, list[int]]:
+        """Byte ranges written to each output file since offsets were taken"""
+        segments = {}
+        for ytd, end in self._get_offsets().items():
+            start = offsets.get(ytd, self._header_ends[ytd])
+            if end > start:
+                segments[str(ytd)] = [start, end]
+        return segments
+
+    def _copy_segment(self, ytd: int, path: Path | str, start: int, end: int) -> None:
+        writer = self._get_writer(ytd)
+        with open(path, "rb") as fp:
+            fp.seek(start)
+            writer.write_bytes(fp.read(end - start))
+
+    @staticmethod
+    def _get_hrp_gho(countryiso3: str) -> tuple[str, str]:
+        hrp = "Y" if Country.get_hrp_status_from_iso3(countryiso3) else "N"
+        gho = "Y" if Country.get_gho_status_from_iso3(countryiso3) else "N"
+        return hrp, gho
 
     def get_pcodes(self) -> None:
-        for admin_level in [1, 2]:
-            admin = AdminLevel(admin_level=admin_level, retriever=self._retriever)
-            admin.setup_from_url()
-            admin.load_pcode_formats()
-            self._admins.append(admin)
+        self._pcode_index = PcodeIndex(self._retriever, self._state_dir)
+        self._pcode_index.setup()
 
-    def download_data(self, countryiso3s: list | None = None) -> None:
-        self.get_pcodes()
-        if not countryiso3s:
-            countryiso3s = [
-                key for key in Country.countriesdata()["countries"] if key != "JPN"
-            ]
+    def _get_retriever(self) -> Retrieve:
+        # Download keeps the current response on the instance so each worker
+        # thread needs its own, but they can share the underlying session
+        retriever = getattr(self._thread_local, "retriever", None)
+        if retriever is None:
+            downloader = Download(session=self._retriever.downloader.session)
+            retriever = self._retriever.clone(downloader)
+            self._thread_local.retriever = retriever
+        return retriever
+
+    def discover_sources(self) -> dict[str, _Source]:
+        """Find the 5ytd resource of every dataset in the rainfall dataseries
+        using paginated searches rather than one read per country.
+
+        Returns:
+            Dictionary of country iso3 to source dataset and resource
+        """
+        datasets = Dataset.search_in_hdx(
+            fq=f'dataseries_name:"{_DATASERIES_NAME}"',
+            page_size=self._configuration["search_page_size"],
+        )
+        self._sources = {}
+        for dataset in datasets:
+            dataset_name = dataset["name"]
+            countryiso3, _, suffix = dataset_name.partition("-")
+            if suffix != "rainfall-subnational":
+                continue
+            countryiso3 = countryiso3.upper()
+            resources = [r for r in dataset.get_resources() if "5ytd" in r["name"]]
+            if len(resources) == 0:
+                source = _Source(countryiso3, dataset_name, dataset["id"])
+            else:
+                resource = resources[0]
+                source = _Source(
+                    countryiso3,
+                    dataset_name,
+                    dataset["id"],
+                    resource["id"],
+                    resource["url"],
+                    resource.get("last_modified", ""),
+                )
+            self._sources[countryiso3] = source
+        logger.info(f"Found {len(self._sources)} rainfall datasets")
+        return self._sources
+
+    def _get_reusable_record(self, source: _Source) -> dict | None:
+        """Get the previous run's record for a country if its source resource
+        is unchanged and no dekad has moved to a different year bucket"""
+        if not self._manifest:
+            return None
+        record = self._manifest.previous.get(source.countryiso3)
+        if not record:
+            return None
+        if record["resource_id"] != source.resource_id:
+            return None
+        if record["last_modified"] != source.last_modified:
+            return None
+        hrp, gho = self._get_hrp_gho(source.countryiso3)
+        if record["hrp"] != hrp or record["gho"] != gho:
+            return None
+        previous_today = self._manifest.previous_today
+        for date in record["dates"]:
+            start_date = parse_date(date)
+            if get_ytd(start_date, self._today) != get_ytd(start_date, previous_today):
+                return None
+        for ytd in record["segments"]:
+            if not self._manifest.get_previous_output(int(ytd)).exists():
+                return None
+        return record
+
+    def _check_country(self, source: _Source) -> _CountryData | None:
+        """Get the data of a country that is not to be downloaded because it
+        has no 5ytd resource or its rows can be reused"""
+        if not source.resource_id:
+            return _CountryData(source, error=("Could not find resource", "warning"))
+        record = self._get_reusable_record(source)
+        if record:
+            return _CountryData(source, record=record)
+        return None
+
+    def _fetch_country(self, source: _Source) -> _CountryData:
+        country_data = self._check_country(source)
+        if country_data:
+            return country_data
+        cached = False
+        try:
+            with self.report.stage("download"):
+                retriever = self._get_retriever()
+                if self._download_cache:
+                    path, cached = self._download_cache.download(
+                        retriever.downloader, source.url
+                    )
+                else:
+                    path = retriever.download_file(source.url)
+        except DownloadError:
+            return _CountryData(source, error=("Could not download resource", "error"))
+        if self.report.enabled:
+            counts = {"file_bytes": getsize(path)}
+            if self._download_cache:
+                counts["cached"] = cached
+            self.report.add_country(source.countryiso3, **counts)
+        return _CountryData(source, path)
+
+    def _fetch_countries(self, countryiso3s: list[str]) -> Iterator[_CountryData]:
+        """Download country files concurrently, yielding them in the order of
+        countryiso3s. At most twice max_workers countries are downloaded ahead
+        of the one being processed."""
+        executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        pending = deque()
         try:
             for countryiso3 in countryiso3s:
-                dataset_name = f"{countryiso3.lower()}-rainfall-subnational"
-                dataset = Dataset.read_from_hdx(dataset_name)
-                if not dataset:
+                source = self._sources.get(countryiso3)
+                if not source:
                     continue
-                dataset_id = dataset["id"]
-                hrp = "Y" if Country.get_hrp_status_from_iso3(countryiso3) else "N"
-                gho = "Y" if Country.get_gho_status_from_iso3(countryiso3) else "N"
-                pcode_lookup = {}
-
-                resources = [r for r in dataset.get_resources() if "5ytd" in r["name"]]
-                if len(resources) == 0:
-                    self._error_handler.add_message(
-                        "Rainfall",
-                        dataset_name,
-                        "Could not find resource",
-                        message_type="warning",
-                    )
+                pending.append(executor.submit(self._fetch_country, source))
+                if len(pending) >= 2 * self._max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _add_dates(self, *dates: datetime) -> None:
+        """Add dates to those of the run. Only the earliest and latest are
+        kept in constant-memory mode as they are all that is needed."""
+        self.dates.update(dates)
+        if self._constant_memory and len(self.dates) > 2:
+            self.dates = {min(self.dates), max(self.dates)}
+
+    def _reuse_country(self, source: _Source, record: dict) -> None:
+        """Copy a country's rows from the previous run's output"""
+        logger.info(f"Reusing unchanged rows for {source.countryiso3}")
+        offsets = self._get_offsets()
+        for ytd, (start, end) in record["segments"].items():
+            ytd = int(ytd)
+            self._copy_segment(ytd, self._manifest.get_previous_output(ytd), start, end)
+        for text, message_type, count in record["messages"]:
+            self._diagnostics.add(text, message_type, count)
+        self._diagnostics.flush(source.dataset_name)
+        if record["start_date"]:
+            self._add_dates(
+                datetime.fromisoformat(record["start_date"]),
+                datetime.fromisoformat(record["end_date"]),
+            )
+        self._manifest.countries[source.countryiso3] = record | {
+            "segments": self._get_segments(offsets)
+        }
+        self.report.add_country(
+            source.countryiso3, reused=True, **record.get("counts", {})
+        )
+
+    def _transform_rows(
+        self, source: _Source, path: Path | Iterable[str], hrp: str, gho: str
+    ) -> tuple[set[str], set[str]]:
+        countryiso3 = source.countryiso3
+        dataset_id = source.dataset_id
+        resource_id = source.resource_id
+        exclude_admin2 = countryiso3 == "BRA" or (hrp == "N" and gho == "N")
+        history = self._history
+        dates = set()
+        kept_dates = set()
+        messages = self._diagnostics.counts
+        no_periods = len(AGGREGATION_PERIODS)
+        with open_lines(path) as fp:
+            headers, rows = prefilter_rows(
+                fp, dates, self._cutoff, exclude_admin2, self._country_counts
+            )
+            pcode_header = "PCODE" if "PCODE" in headers else "ADM2_PCODE"
+            wfp_id_header = "adm_id" if "adm_id" in headers else "adm2_id"
+            for values in rows:
+                row = {header: value or None for header, value in zip(headers, values)}
+                row_non_null = [r for r in row if r]
+                if "#" in row_non_null[0]:
                     continue
-                resource = resources[0]
-                resource_id = resource["id"]
-                try:
-                    headers, rows = self._retriever.get_tabular_rows(
-                        resource["url"], dict_form=True
+
+                admin_level = int(row.get("adm_level", 2))
+                if admin_level == 2 and exclude_admin2:
+                    continue
+
+                dekad_dates = self._dekad_table.get(row["date"])
+                ytd = dekad_dates.ytd
+                if ytd > 1 and admin_level > 1 and not history:
+                    continue
+                kept_dates.add(row["date"])
+
+                pcode = row[pcode_header]
+                if admin_level == 1:
+                    provider_names = ["Not provided", ""]
+                    provider_codes = [str(row[wfp_id_header]), ""]
+                    adm_codes, adm_names, warnings = self._pcode_index.resolve(
+                        countryiso3, 1, pcode
                     )
-                except DownloadError:
-                    self._error_handler.add_message(
-                        "Rainfall",
-                        dataset_name,
-                        "Could not download resource",
+                else:
+                    provider_names = ["Not provided", "Not provided"]
+                    provider_codes = ["", str(row[wfp_id_header])]
+                    adm_codes, adm_names, warnings = self._pcode_index.resolve(
+                        countryiso3, 2, pcode
                     )
-                    continue
-                pcode_header = "PCODE" if "PCODE" in headers else "ADM2_PCODE"
-                wfp_id_header = "adm_id" if "adm_id" in headers else "adm2_id"
-                for row in rows:
-                    row_non_null = [r for r in row if r]
-                    if "#" in row_non_null[0]:
-                        continue
-
-                    admin_level = int(row.get("adm_level", 2))
-                    if admin_level == 2 and (
-                        countryiso3 == "BRA" or (hrp == "N" and gho == "N")
-                    ):
-                        continue
-
-                    start_date = parse_date(row["date"])
-                    days_ago = (self._today - start_date).days
-                    ytd = ceil(days_ago / 365)
-                    if days_ago > 365 and admin_level > 1:
-                        continue
-
-                    pcode = row[pcode_header]
-                    if admin_level == 1:
-                        provider_names = ["Not provided", ""]
-                        provider_codes = [str(row[wfp_id_header]), ""]
-                        adm_codes = [pcode, ""]
-                    else:
-                        provider_names = ["Not provided", "Not provided"]
-                        provider_codes = ["", str(row[wfp_id_header])]
-                        adm_codes = ["", pcode]
-                    adm_names = ["", ""]
-                    if pcode in pcode_lookup:
-                        adm_codes = pcode_lookup[pcode][0]
-                        adm_names = pcode_lookup[pcode][1]
-                        warnings = pcode_lookup[pcode][2]
-                    else:
-                        try:
-                            adm_level, warnings = complete_admins(
-                                self._admins,
-                                countryiso3,
-                                ["", ""],
-                                adm_codes,
-                                adm_names,
-                                fuzzy_match=False,
-                            )
-                        except IndexError:
-                            warnings = [f"Pcode unknown {adm_codes[1]}"]
-                            adm_codes = ["", ""]
-                        pcode_lookup[pcode] = (adm_codes, adm_names, warnings)
-                    for warning in warnings:
-                        self._error_handler.add_message(
-                            "Rainfall",
-                            dataset_name,
-                            warning,
-                            message_type="warning",
-                        )
+                for warning in warnings:
+                    messages[(warning, "warning")] += no_periods
 
-                    version = _VERSIONS.get(row["version"])
-                    dekad = Dekad.fromdatetime(start_date)
-                    end_date = (dekad + 1).todate() - timedelta(days=1)
-                    end_date = parse_date(str(end_date))
-                    self.dates.add(start_date)
-                    self.dates.add(end_date)
-                    start_date_iso = iso_string_from_datetime(start_date)
-                    end_date_iso = iso_string_from_datetime(end_date)
-
-                    for agg_header, aggregation_period in _AGGREGATION_PERIODS.items():
-                        errors = []
-                        if not version:
-                            errors.append(f"Version unknown {row['version']}")
-                            self._error_handler.add_message(
-                                "Rainfall",
-                                dataset_name,
-                                f"Version unknown {row['version']}",
-                            )
-                        rainfall = row[f"r{agg_header}h"]
-                        rainfall_long_term_average = row[f"r{agg_header}h_avg"]
-                        rainfall_anomaly_pct = row[f"r{agg_header}q"]
-                        if None in [
+                version = VERSIONS.get(row["version"])
+                if not version:
+                    version_error = f"Version unknown {row['version']}"
+                    messages[(version_error, "error")] += no_periods
+                number_pixels = int(float(row["n_pixels"]))
+                writer = self._get_writer(ytd)
+
+                for agg_header, aggregation_period in AGGREGATION_PERIODS.items():
+                    errors = []
+                    if not version:
+                        errors.append(version_error)
+                    rainfall = row[f"r{agg_header}h"]
+                    rainfall_long_term_average = row[f"r{agg_header}h_avg"]
+                    rainfall_anomaly_pct = row[f"r{agg_header}q"]
+                    if None in [
+                        rainfall,
+                        rainfall_long_term_average,
+                        rainfall_anomaly_pct,
+                    ]:
+                        errors.append("Missing rainfall value")
+                    # Values in the order of HAPI_FIELDS
+                    writer.writerow(
+                        (
+                            countryiso3,
+                            hrp,
+                            gho,
+                            provider_names[0],
+                            provider_names[1],
+                            adm_codes[0],
+                            adm_names[0],
+                            adm_codes[1],
+                            adm_names[1],
+                            admin_level,
+                            provider_codes[0],
+                            provider_codes[1],
+                            aggregation_period,
                             rainfall,
                             rainfall_long_term_average,
                             rainfall_anomaly_pct,
-                        ]:
-                            errors.append("Missing rainfall value")
-                        hapi_row = {
-                            "location_code": countryiso3,
-                            "has_hrp": hrp,
-                            "in_gho": gho,
-                            "provider_admin1_name": provider_names[0],
-                            "provider_admin2_name": provider_names[1],
-                            "admin1_code": adm_codes[0],
-                            "admin1_name": adm_names[0],
-                            "admin2_code": adm_codes[1],
-                            "admin2_name": adm_names[1],
-                            "admin_level": admin_level,
-                            "provider_admin1_code": provider_codes[0],
-                            "provider_admin2_code": provider_codes[1],
-                            "aggregation_period": aggregation_period,
-                            "rainfall": rainfall,
-                            "rainfall_long_term_average": rainfall_long_term_average,
-                            "rainfall_anomaly_pct": rainfall_anomaly_pct,
-                            "number_pixels": int(float(row["n_pixels"])),
-                            "version": version,
-                            "reference_period_start": start_date_iso,
-                            "reference_period_end": end_date_iso,
-                            "dataset_hdx_id": dataset_id,
-                            "resource_hdx_id": resource_id,
-                            "warning": "|".join(warnings),
-                            "error": "|".join(errors),
-                        }
-                        self._write_hapi_row(ytd, hapi_row)
+                            number_pixels,
+                            version,
+                            dekad_dates.start_date_iso,
+                            dekad_dates.end_date_iso,
+                            dataset_id,
+                            resource_id,
+                            "|".join(warnings),
+                            "|".join(errors),
+                        )
+                    )
+        return dates, kept_dates
+
+    def _transform_columnar(
+        self, source: _Source, path: Path | Iterable[str], hrp: str, gho: str
+    ) -> tuple[set[str], set[str]]:
+        from hdx.scraper.wfp_rainfall.columnar import transform_columnar
+
+        result = transform_columnar(
+            path,
+            source.countryiso3,
+            hrp,
+            gho,
+            source.dataset_id,
+            source.resource_id,
+            self._configuration["headers"],
+            self._get_writer,
+            self._dekad_table,
+            self._pcode_index,
+            self._cutoff,
+            self._country_counts,
+            self._history,
+            self._configuration["columnar_chunk_size"],
+        )
+        self._diagnostics.update(result.messages)
+        return result.dates, result.kept_dates
+
+    def _transform_country(
+        self, source: _Source, path: Path | Iterable[str], hrp: str, gho: str
+    ) -> tuple[set[str], set[str]]:
+        """Write a country's HAPI rows from its file or the lines streamed
+        from it, returning the dates in the source file and those of the rows
+        written"""
+        if self._engine == "columnar":
+            return self._transform_columnar(source, path, hrp, gho)
+        return self._transform_rows(source, path, hrp, gho)
+
+    def _copy_shard(self, shard: _Shard) -> tuple[set[str], set[str]]:
+        """Copy a country's rows written by a worker process and delete its
+        shard files"""
+        for ytd, (path, start, end) in shard.segments.items():
+            self._copy_segment(int(ytd), path, start, end)
+        rmtree(shard.folder, ignore_errors=True)
+        self._diagnostics.update(shard.messages)
+        self._country_counts.update(shard.counts)
+        self._pcode_index.add_resolved(shard.resolved)
+        for name, (seconds, count) in shard.stages.items():
+            self.report.add_time(name, seconds, count)
+        return shard.dates, shard.kept_dates
+
+    def _process_country(
+        self, country_data: _CountryData, shard: Future | None = None
+    ) -> None:
+        source = country_data.source
+        countryiso3 = source.countryiso3
+        dataset_name = source.dataset_name
+        if country_data.error:
+            self._diagnostics.add(*country_data.error)
+            self._diagnostics.flush(dataset_name)
+            return
+        if country_data.record:
+            with self.report.stage("reuse"):
+                self._reuse_country(source, country_data.record)
+            return
+        hrp, gho = self._get_hrp_gho(countryiso3)
+        if self._history:
+            self._group = self._get_group(countryiso3)
+            self._close_full_parts()
+        offsets = self._get_offsets()
+        rows = {key: writer.rows for key, writer in self._writers.items()}
+        rows_written = self._get_rows_written()
+        self._diagnostics.reset()
+        self._country_counts = {}
+        try:
+            if shard:
+                with self.report.stage("merge"):
+                    dates, kept_dates = self._copy_shard(shard.result())
+            else:
+                if country_data.lines is None:
+                    path = country_data.path
+                else:
+                    path = country_data.lines
+                with self.report.stage("transform"):
+                    dates, kept_dates = self._transform_country(source, path, hrp, gho)
+                self._country_counts["written"] = (
+                    self._get_rows_written() - rows_written
+                )
+        except (csv.Error, UnicodeDecodeError):
+            self._rollback(offsets, rows)
+            self._diagnostics.reset()
+            self._diagnostics.add("Could not read resource")
+            self._diagnostics.flush(dataset_name)
+            return
+        except DownloadError:
+            # Raised part way through a file streamed in asynchronous mode
+            self._rollback(offsets, rows)
+            self._diagnostics.reset()
+            self._diagnostics.add("Could not download resource")
+            self._diagnostics.flush(dataset_name)
+            return
+        finally:
+            self._delete_download(country_data.path)
+        messages = self._diagnostics.flush(dataset_name)
+        counts = {
+            "read": self._country_counts.get("read", 0),
+            "kept": self._country_counts.get("written", 0) // len(AGGREGATION_PERIODS),
+            "written": self._country_counts.get("written", 0),
+        }
+        self.report.add_country(countryiso3, **counts)
+
+        min_start_date = None
+        max_end_date = None
+        for date in kept_dates:
+            dekad_dates = self._dekad_table.get(date)
+            if not self._constant_memory:
+                self.dates.add(dekad_dates.start_date)
+                self.dates.add(dekad_dates.end_date)
+            if min_start_date is None or dekad_dates.start_date < min_start_date:
+                min_start_date = dekad_dates.start_date
+            if max_end_date is None or dekad_dates.end_date > max_end_date:
+                max_end_date = dekad_dates.end_date
+        if self._constant_memory and min_start_date:
+            self._add_dates(min_start_date, max_end_date)
+        if self._manifest:
+            self._manifest.countries[countryiso3] = {
+                "resource_id": source.resource_id,
+                "last_modified": source.last_modified,
+                "hrp": hrp,
+                "gho": gho,
+                # Dates repeat across countries so are kept only once
+                "dates": sorted(map(sys.intern, dates)),
+                "start_date": min_start_date.isoformat() if min_start_date else "",
+                "end_date": max_end_date.isoformat() if max_end_date else "",
+                "segments": self._get_segments(offsets),
+                "messages": messages,
+                "counts": counts,
+            }
+
+    def _finish_country(
+        self, country_data: _CountryData, shard: Future | None = None
+    ) -> None:
+        self._process_country(country_data, shard)
+        if self._checkpoint:
+            with self.report.stage("checkpoint"):
+                self._save_checkpoint(country_data.source)
+
+    def _save_checkpoint(self, source: _Source) -> None:
+        """Record that a country is finished along with where each open
+        output ends, which writes out any rows held by the writers"""
+        countryiso3 = source.countryiso3
+        writers = []
+        for key, writer in self._writers.items():
+            ytd, group = key if isinstance(key, tuple) else (key, "")
+            writers.append(
+                {
+                    "ytd": ytd,
+                    "group": group,
+                    "name": writer.path.name,
+                    "offset": writer.tell(),
+                    "header_end": self._header_ends[key],
+                }
+            )
+        if self._manifest:
+            record = self._manifest.countries.get(countryiso3)
+        else:
+            record = None
+        if self.dates:
+            dates = [min(self.dates).isoformat(), max(self.dates).isoformat()]
+        else:
+            dates = []
+        self._checkpoint.add_country(
+            {
+                "countryiso3": countryiso3,
+                "dataset_name": source.dataset_name,
+                "messages": self._diagnostics.get_messages(source.dataset_name),
+                "dates": dates,
+                "record": record,
+                "counts": self.report.countries.get(countryiso3, {}),
+                "writers": writers,
+                "data": {ytd: path.name for ytd, path in self.data.items()},
+                "partitions": [
+                    [ytd, group, part, path.name]
+                    for (ytd, group, part), path in self.partitions.items()
+                ],
+                "parts": [
+                    [ytd, group, part] for (ytd, group), part in self._parts.items()
+                ],
+            }
+        )
+
+    def _load_checkpoint(self) -> set[str]:
+        """Resume from the checkpoint of a failed run if asked to and it can
+        be, otherwise start a new checkpoint, deleting any outputs left by an
+        earlier run. When resuming, the date of the failed run is used so that
+        the year-to-date periods of the countries still to do match those
+        already finished. Open outputs are truncated to where they were when
+        the last country finished.
+
+        Returns:
+            Countries already finished
+        """
+        loaded = None
+        if self._resume:
+            loaded = self._checkpoint.load(self._pcode_index.hash)
+        if not loaded:
+            for path in Path(self._temp_dir).glob("hdx_hapi_rainfall_*"):
+                path.unlink()
+            self._checkpoint.start(self._today.isoformat(), self._pcode_index.hash)
+            return set()
+        run, countries = loaded
+        self._set_today(datetime.fromisoformat(run["today"]))
+        self._checkpoint.resume(len(countries))
+        for country in countries:
+            countryiso3 = country["countryiso3"]
+            for text, message_type, count in country["messages"]:
+                self._diagnostics.add(text, message_type, count)
+            self._diagnostics.flush(country["dataset_name"])
+            self._add_dates(*(datetime.fromisoformat(x) for x in country["dates"]))
+            if self._manifest and country["record"]:
+                self._manifest.countries[countryiso3] = country["record"]
+            self.report.add_country(countryiso3, **country["counts"])
+        if countries:
+            last = countries[-1]
+            folder = Path(self._temp_dir)
+            self.data = {int(ytd): folder / name for ytd, name in last["data"].items()}
+            self.partitions = {
+                (ytd, group, part): folder / name
+                for ytd, group, part, name in last["partitions"]
+            }
+            self._parts = {(ytd, group): part for ytd, group, part in last["parts"]}
+            for writer in last["writers"]:
+                ytd = writer["ytd"]
+                key = (ytd, writer["group"]) if writer["group"] else ytd
+                self._open_writer(
+                    key,
+                    folder / writer["name"],
+                    writer["offset"],
+                    writer["header_end"],
+                )
+        return {country["countryiso3"] for country in countries}
+
+    def delete_outputs(self) -> None:
+        """Delete the output files and checkpoint once they are no longer
+        needed, eg. after uploading them. The run report is kept."""
+        for path in self.get_outputs().values():
+            path.unlink(missing_ok=True)
+        if self._checkpoint:
+            self._checkpoint.delete()
+
+    def _delete_download(self, path: Path) -> None:
+        """Delete a country file once transformed so that downloads do not
+        accumulate in the temporary folder, unless it is in the saved folder
+        or download cache"""
+        if self._retriever.save or self._retriever.use_saved or self._download_cache:
+            return
+        if path is None:
+            return
+        Path(path).unlink(missing_ok=True)
+
+    def _process_countries_sharded(self, country_datas: Iterator[_CountryData]) -> None:
+        """Transform countries in a pool of worker processes. Workers write
+        each country to its own shard files which are copied into the output
+        files in country order and then deleted. Workers get a read only copy
+        of the p-code index, with its AdminLevel objects set up here once."""
+        with self.report.stage("pcodes"):
+            self._pcode_index.setup_admins()
+        shard_root = Path(self._temp_dir) / "shards"
+        shard_root.mkdir(parents=True, exist_ok=True)
+        executor = ProcessPoolExecutor(
+            max_workers=self._processes,
+            initializer=_init_worker,
+            initargs=(
+                self._configuration,
+                str(shard_root),
+                self._today,
+                self._engine,
+                self._pcode_index,
+                self._history,
+            ),
+        )
+        pending = deque()
+        try:
+            for country_data in country_datas:
+                shard = None
+                if country_data.path:
+                    hrp, gho = self._get_hrp_gho(country_data.source.countryiso3)
+                    shard = executor.submit(
+                        _transform_in_worker,
+                        country_data.source,
+                        country_data.path,
+                        hrp,
+                        gho,
+                    )
+                pending.append((country_data, shard))
+                if len(pending) >= 2 * self._processes:
+                    self._finish_country(*pending.popleft())
+            while pending:
+                self._finish_country(*pending.popleft())
         finally:
-            for fh in self._csv_handles.values():
-                fh.close()
-            self._csv_handles.clear()
-            self._csv_writers.clear()
+            executor.shutdown(cancel_futures=True)
+            rmtree(shard_root, ignore_errors=True)
+
+    async def _stream_chunks(self, source: _Source, chunks: asyncio.Queue) -> None:
+        """Put the chunks of a country file in a queue as they are downloaded,
+        or read if using saved data, then None or any exception raised"""
+        chunk_size = self._configuration["async_chunk_size"]
+        downloader = None
+        fp = None
+        try:
+            if self._retriever.use_saved:
+                fp = await asyncio.to_thread(
+                    open, self._retriever.download_file(source.url), "rb"
+                )
+                read = partial(fp.read, chunk_size)
+            else:
+                downloader = Download(session=self._retriever.downloader.session)
+                response = await asyncio.to_thread(
+                    downloader.setup,
+                    source.url,
+                    stream=True,
+                    headers={"Accept-Encoding": "gzip"},
+                )
+                read = partial(next, response.iter_content(chunk_size), b"")
+            file_bytes = 0
+            while chunk := await asyncio.to_thread(read):
+                file_bytes += len(chunk)
+                self.report.add_queue_depth("chunks", chunks.qsize(), chunks.maxsize)
+                await chunks.put(chunk)
+            self.report.add_country(source.countryiso3, file_bytes=file_bytes)
+            await chunks.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            if not isinstance(ex, DownloadError):
+                ex = DownloadError(f"Download of {source.url} failed!")
+            await chunks.put(ex)
+        finally:
+            if fp:
+                fp.close()
+            if downloader:
+                # The session is shared so only the response is closed
+                downloader.close_response()
+
+    async def _split_lines(self, chunks: asyncio.Queue, lines: asyncio.Queue) -> None:
+        """Put the lines of each chunk of a country file in a queue, then None
+        or any exception raised"""
+        splitter = LineSplitter()
+        try:
+            while True:
+                chunk = await chunks.get()
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                batch = splitter.split(chunk or b"", final=chunk is None)
+                if batch:
+                    self.report.add_queue_depth("lines", lines.qsize(), lines.maxsize)
+                    await lines.put(batch)
+                if chunk is None:
+                    break
+            await lines.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            await lines.put(ex)
+
+    async def _produce_countries(
+        self,
+        countryiso3s: list[str],
+        countries: asyncio.Queue,
+        tasks: list[asyncio.Task],
+    ) -> None:
+        """Put each country in a queue in order, starting to stream its file
+        through queues of chunks and lines if it is to be downloaded. Waits
+        while the queue is full so that only so many countries are in flight
+        ahead of the one being transformed."""
+        loop = asyncio.get_running_loop()
+        queue_size = self._configuration["async_queue_size"]
+        try:
+            for countryiso3 in countryiso3s:
+                source = self._sources.get(countryiso3)
+                if not source:
+                    continue
+                country_data = self._check_country(source)
+                if not country_data:
+                    chunks = asyncio.Queue(queue_size)
+                    lines = asyncio.Queue(queue_size)
+                    country_tasks = (
+                        asyncio.create_task(self._stream_chunks(source, chunks)),
+                        asyncio.create_task(self._split_lines(chunks, lines)),
+                    )
+                    tasks.extend(country_tasks)
+                    country_data = _CountryData(
+                        source,
+                        lines=chain.from_iterable(iter_queue(lines, loop)),
+                        tasks=country_tasks,
+                    )
+                self.report.add_queue_depth(
+                    "countries", countries.qsize(), countries.maxsize
+                )
+                await countries.put(country_data)
+            await countries.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            await countries.put(ex)
+
+    def _consume_countries(
+        self, countries: asyncio.Queue, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        for country_data in iter_queue(countries, loop):
+            try:
+                self._finish_country(country_data)
+            finally:
+                # Stop streaming a file that was not read to the end, eg. as
+                # its transform raised, rather than leave its tasks waiting on
+                # full queues
+                for task in country_data.tasks:
+                    loop.call_soon_threadsafe(task.cancel)
+
+    async def _process_countries_async(self, countryiso3s: list[str]) -> None:
+        """Stream country files through bounded queues: chunks are downloaded
+        and split into lines in the event loop while a single thread
+        transforms each country in order from its lines and writes the
+        rows. When a queue is full, the stage putting into it waits, which
+        bounds memory use. Queue depths are in the run report."""
+        loop = asyncio.get_running_loop()
+        countries = asyncio.Queue(self._max_workers)
+        tasks = []
+        producer = asyncio.create_task(
+            self._produce_countries(countryiso3s, countries, tasks)
+        )
+        try:
+            await asyncio.to_thread(self._consume_countries, countries, loop)
+        finally:
+            for task in [producer, *tasks]:
+                task.cancel()
+            await asyncio.gather(producer, *tasks, return_exceptions=True)
+
+    def download_data(self, countryiso3s: list | None = None) -> None:
+        with self.report.stage("pcodes"):
+            self.get_pcodes()
+        if self._download_cache:
+            with self.report.stage("cache_load"):
+                self._download_cache.load()
+        finished = set()
+        if self._checkpoint:
+            with self.report.stage("checkpoint_load"):
+                finished = self._load_checkpoint()
+        if self._manifest and not self._full_refresh:
+            with self.report.stage("manifest_load"):
+                self._manifest.load(self._pcode_index.hash)
+        if not self._sources:
+            with self.report.stage("discover"):
+                self.discover_sources()
+        if not countryiso3s:
+            countryiso3s = [
+                key for key in Country.countriesdata()["countries"] if key != "JPN"
+            ]
+        countryiso3s = [x for x in countryiso3s if x not in finished]
+        try:
+            if self._asynchronous:
+                asyncio.run(self._process_countries_async(countryiso3s))
+            elif self._processes > 1:
+                self._process_countries_sharded(self._fetch_countries(countryiso3s))
+            else:
+                for country_data in self._fetch_countries(countryiso3s):
+                    self._finish_country(country_data)
+        finally:
+            with self.report.stage("close"):
+                for key in list(self._writers):
+                    self._close_writer(key)
+                if self._checkpoint:
+                    self._checkpoint.close()
+        if "parquet" in self._extra_formats:
+            with self.report.stage("parquet"):
+                self._write_parquets()
+        self.report.add_time(
+            "pcode_fallback",
+            self._pcode_index.fallback_seconds,
+            self._pcode_index.fallbacks,
+        )
+        with self.report.stage("state_save"):
+            self._pcode_index.save()
+            if self._manifest:
+                self._manifest.save(self.data, self._pcode_index.hash)
+            if self._download_cache:
+                self._download_cache.save()
+
+    def save_report(self) -> Path | None:
+        """Write the run report next to the output files if enabled
+
+        Returns:
+            Path of report or None if not enabled
+        """
+        if not self.report.enabled:
+            return None
+        path = Path(self._temp_dir) / "run_report.json"
+        self.report.save(
+            path,
+            self._today,
+            engine=self._engine,
+            processes=self._processes,
+            asynchronous=self._asynchronous,
+            constant_memory=self._constant_memory,
+            history=self._history,
+            unchanged_resources=self.unchanged,
+            outputs={
+                name: getsize(path)
+                for name, path in self.get_outputs().items()
+                if path.exists()
+            },
+            messages=self._diagnostics.get_summary(),
+        )
+        return path
+
+    def set_upload_statuses(self, statuses: dict[str, int]) -> None:
+        """Record the resources whose files were not uploaded as HDX found
+        their hash and size unchanged, from the statuses by resource name
+        returned by create_in_hdx (3 or 4 if not uploaded)
+
+        Args:
+            statuses: Status of each resource by name
+        """
+        self.unchanged = [name for name, status in statuses.items() if status in (3, 4)]
+        if self.unchanged:
+            logger.info(f"{len(self.unchanged)} unchanged resources were not uploaded")
 
     def generate_global_dataset(self) -> Dataset:
+        """Generate the global dataset with a resource for each output file.
+        HDX does not upload a file whose hash and size are unchanged.
+
+        Returns:
+            Global dataset
+        """
         dataset = Dataset(
             {
-                "name": "hdx-hapi-rainfall",
+                "name": _DATASET_NAME,
                 "title": "HDX HAPI - Climate: Rainfall",
             }
         )
@@ -244,17 +1119,130 @@ class Pipeline:
         end_date = max(self.dates)
         dataset.set_time_period(start_date, end_date)
 
-        for ytd in sorted(self.data.keys()):
+        if self._history:
+            for ytd, group, part in sorted(self.partitions):
+                self._add_resource(
+                    dataset,
+                    "history_resource",
+                    self.partitions[(ytd, group, part)],
+                    ytd=ytd,
+                    group=group,
+                    part=part,
+                )
+        else:
+            for ytd in sorted(self.data.keys()):
+                self._add_resource(dataset, "resource", self.data[ytd], ytd=ytd)
+
+        return dataset
+
+    def _add_resource(
+        self, dataset: Dataset, config_prefix: str, path: Path, **kwargs
+    ) -> None:
+        """Add the resource of an output file, followed by one for each of its
+        copies in extra formats"""
+        name = self._configuration[f"{config_prefix}_name"].format(**kwargs)
+        description = self._configuration[f"{config_prefix}_description"].format(
+            **kwargs
+        )
+        file_formats = [("csv", name, path)]
+        for extra_format in self._extra_formats:
+            label = self._configuration["format_labels"][extra_format]
+            file_formats.append(
+                (
+                    _EXTRA_FORMATS[extra_format],
+                    f"{name} - {label}",
+                    _get_format_path(path, extra_format),
+                )
+            )
+        for file_format, resource_name, resource_path in file_formats:
             resourcedata = {
-                "name": self._configuration["resource_name"].format(ytd=ytd),
-                "description": self._configuration["resource_description"].format(
-                    ytd=ytd
-                ),
+                "name": resource_name,
+                "description": description,
                 "p_coded": True,
             }
             resource = Resource(resourcedata)
-            resource.set_format("csv")
-            resource.set_file_to_upload(self.data[ytd])
+            resource.set_format(file_format)
+            resource.set_file_to_upload(resource_path)
             dataset.add_update_resource(resource)
 
-        return dataset
+
+def _get_format_path(path: Path, file_format: str) -> Path:
+    """Get the path of the copy of an output CSV file in another format"""
+    return path.with_name(f"{path.stem}.{file_format}")
+
+
+_worker: Pipeline | None = None
+
+
+def _init_worker(
+    configuration: Configuration,
+    shard_root: str,
+    today: datetime,
+    engine: str,
+    pcode_index: PcodeIndex,
+    history: bool,
+) -> None:
+    global _worker
+    shard_dir = mkdtemp(dir=shard_root)
+    downloader = Download(user_agent=configuration.get_user_agent())
+    retriever = Retrieve(downloader, shard_dir, shard_dir, shard_dir)
+    pcode_index.set_retriever(retriever)
+    _worker = Pipeline(
+        configuration,
+        retriever,
+        shard_dir,
+        None,
+        today,
+        engine=engine,
+        history=history,
+    )
+    _worker._pcode_index = pcode_index
+
+
+def _transform_in_worker(source: _Source, path: Path, hrp: str, gho: str) -> _Shard:
+    """Write a country's HAPI rows to new shard files in their own folder,
+    returning where they are. The shard files are closed whether or not the
+    transform succeeds so that nothing is carried over to the next country,
+    and deleted if it fails."""
+    _worker._temp_dir = mkdtemp(dir=_worker._retriever.temp_dir)
+    pcode_index = _worker._pcode_index
+    fallbacks = pcode_index.fallbacks
+    fallback_seconds = pcode_index.fallback_seconds
+    _worker._diagnostics.reset()
+    _worker._country_counts = {}
+    succeeded = False
+    try:
+        start = perf_counter()
+        dates, kept_dates = _worker._transform_country(source, path, hrp, gho)
+        stages = {
+            "transform": (perf_counter() - start, 1),
+            "pcode_fallback": (
+                pcode_index.fallback_seconds - fallback_seconds,
+                pcode_index.fallbacks - fallbacks,
+            ),
+        }
+        _worker._country_counts["written"] = _worker._get_rows_written()
+        segments = {
+            ytd: (str(_worker.data[int(ytd)]), start, end)
+            for ytd, (start, end) in _worker._get_segments({}).items()
+        }
+        succeeded = True
+    finally:
+        for writer in _worker._writers.values():
+            writer.close()
+        _worker._writers.clear()
+        _worker._header_ends.clear()
+        _worker.data.clear()
+        if not succeeded:
+            _worker._diagnostics.reset()
+            rmtree(_worker._temp_dir, ignore_errors=True)
+    return _Shard(
+        _worker._temp_dir,
+        segments,
+        dates,
+        kept_dates,
+        _worker._diagnostics.counts,
+        pcode_index.pop_new_resolved(),
+        _worker._country_counts,
+        stages,
+    )
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""Streaming reader of country rainfall files that discards rows which will
+not be output before they are parsed further"""
+
+import csv
+from collections.abc import Iterable, Iterator
+from contextlib import AbstractContextManager, nullcontext
+from datetime import datetime, timedelta
+from itertools import chain
+from pathlib import Path
+from typing import TextIO
+
+
+def get_cutoff(today: datetime) -> str:
+    """Get the ISO date before which admin 2 rows are more than a year old.
+    It is a day earlier than strictly needed so that the time of day of today
+    cannot cause a row that should be kept to be discarded.
+
+    Args:
+        today: Date of run
+
+    Returns:
+        Cutoff date in YYYY-MM-DD form
+    """
+    return (today - timedelta(days=366)).strftime("%Y-%m-%d")
+
+
+def open_lines(
+    path: Path | str | Iterable[str],
+) -> AbstractContextManager[Iterable[str]]:
+    """Open a rainfall file for prefilter_rows or, in asynchronous mode, pass
+    through the lines already streamed from one
+
+    Args:
+        path: Path to rainfall file or its lines
+
+    Returns:
+        Context manager giving the lines of the file
+    """
+    if isinstance(path, (Path, str)):
+        return open(path, newline="", encoding="utf-8-sig")
+    return nullcontext(path)
+
+
+def prefilter_rows(
+    fp: TextIO | Iterable[str],
+    dates: set[str],
+    cutoff: str,
+    exclude_admin2: bool,
+    counts: dict[str, int] | None = None,
+) -> tuple[list[str], Iterator[list[str]]]:
+    """Read the headers of a rainfall file and return an iterator over its
+    rows that skips admin 2 rows which are excluded or older than cutoff. Only
+    the date and admin level of each line are examined to decide this: lines
+    are split on commas unless they contain quotes and dates are compared as
+    strings. Rows that pass are padded to the length of the headers but may
+    still need to be filtered by the caller.
+
+    Args:
+        fp: Rainfall file opened with newline="" or its lines
+        dates: Set to which the date of every row is added
+        cutoff: ISO date before which admin 2 rows are skipped
+        exclude_admin2: Whether to skip all admin 2 rows
+        counts: Dictionary in which to put number of rows read. Defaults to None.
+
+    Returns:
+        Tuple of (headers, iterator over rows)
+    """
+    headers = next(csv.reader(fp), [])
+    no_headers = len(headers)
+    date_index = headers.index("date")
+    level_index = headers.index("adm_level") if "adm_level" in headers else None
+
+    def rows() -> Iterator[list[str]]:
+        lines = iter(fp)
+        no_rows = 0
+        for line in lines:
+            if '"' in line:
+                # Quoted values can contain commas and span several lines
+                values = next(csv.reader(chain([line], lines)))
+            else:
+                values = line.rstrip("\r\n").split(",")
+            if not any(values):
+                continue
+            no_rows += 1
+            if len(values) < no_headers:
+                values.extend([""] * (no_headers - len(values)))
+            date = values[date_index]
+            dates.add(date)
+            if level_index is None or values[level_index] == "2":
+                if exclude_admin2:
+                    continue
+                if len(date) == 10 and date[4] == "-" and date < cutoff:
+                    continue
+            yield values[:no_headers]
+        if counts is not None:
+            counts["read"] = no_rows
+
+    return headers, rows()
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""Timings and counts of a run written to a JSON report"""
+
+import json
+import logging
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_NO_STAGE = nullcontext()
+
+
+def get_peak_rss() -> dict[str, int]:
+    """Get peak resident set size in bytes of this process and of the largest
+    of its finished child processes (eg. transform workers)"""
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+
+class _Stage:
+    __slots__ = ("_report", "_name", "_start")
+
+    def __init__(self, report: "RunReport", name: str):
+        self._report = report
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._start = perf_counter()
+
+    def __exit__(self, *args) -> None:
+        self._report.add_time(self._name, perf_counter() - self._start)
+
+
+class RunReport:
+    """Collects the time spent in each stage of a run, per country counts of
+    rows read, kept and written and file sizes and, in asynchronous
+    mode, the depths of the queues between stages. When not enabled, stage
+    returns a shared do nothing context manager and the add methods return
+    immediately so that instrumentation can be left in place.
+
+    Stages that run in several threads at once, eg. download, are summed so
+    they can add up to more than the elapsed time.
+
+    Args:
+        enabled: Whether to collect anything. Defaults to True.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._start = perf_counter()
+        self.stages: dict[str, dict[str, float | int]] = {}
+        self.countries: dict[str, dict[str, int | bool]] = {}
+        self.queues: dict[str, dict[str, int]] = {}
+
+    def stage(self, name: str) -> _Stage | nullcontext:
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def add_time(self, name: str, seconds: float, count: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = {"seconds": seconds, "count": count}
+            else:
+                stage["seconds"] += seconds
+                stage["count"] += count
+
+    def add_country(self, countryiso3: str, **counts: int | bool) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            country = self.countries.setdefault(countryiso3, {})
+            for key, value in counts.items():
+                if isinstance(value, bool):
+                    country[key] = value
+                else:
+                    country[key] = country.get(key, 0) + value
+
+    def add_queue_depth(self, name: str, depth: int, maxsize: int) -> None:
+        """Add the number of items in a queue when an item is put in it"""
+        if not self.enabled:
+            return
+        with self._lock:
+            queue = self.queues.get(name)
+            if queue is None:
+                self.queues[name] = {
+                    "maxsize": maxsize,
+                    "puts": 1,
+                    "total_depth": depth,
+                    "max_depth": depth,
+                    "full": int(depth >= maxsize),
+                }
+            else:
+                queue["puts"] += 1
+                queue["total_depth"] += depth
+                queue["max_depth"] = max(queue["max_depth"], depth)
+                queue["full"] += depth >= maxsize
+
+    def get_totals(self) -> dict[str, int]:
+        totals = {}
+        for country in self.countries.values():
+            for key, value in country.items():
+                if not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def save(self, path: Path | str, today: datetime, **extra) -> None:
+        if not self.enabled:
+            return
+        report = {
+            "today": today.isoformat(),
+            "elapsed_seconds": perf_counter() - self._start,
+            "peak_rss_bytes": get_peak_rss(),
+            "stages": {
+                name: {"seconds": round(stage["seconds"], 6), "count": stage["count"]}
+                for name, stage in self.stages.items()
+            },
+            "totals": self.get_totals(),
+            "countries": self.countries,
+        }
+        if self.queues:
+            report["queues"] = {
+                name: {
+                    "maxsize": queue["maxsize"],
+                    "puts": queue["puts"],
+                    "mean_depth": round(queue["total_depth"] / queue["puts"], 2),
+                    "max_depth": queue["max_depth"],
+                    "full": queue["full"],
+                }
+                for name, queue in self.queues.items()
+            }
+        report |= extra
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=1)
+        logger.info(f"Saved run report to {path}")
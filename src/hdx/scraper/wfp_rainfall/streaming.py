@@ -0,0 +1,59 @@
+#!/usr/bin/python
+"""Helpers for asynchronous mode, where country files are streamed through
+bounded asyncio queues into a thread that transforms and writes them"""
+
+import asyncio
+import codecs
+from collections.abc import Iterator
+from io import StringIO
+from typing import Any
+
+
+class LineSplitter:
+    """Splits a stream of bytes from a rainfall file into lines as they would
+    be read from the file opened with newline="" and encoding "utf-8-sig". A
+    line or character split across chunks is held until the next chunk.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._pending = ""
+
+    def split(self, data: bytes, final: bool = False) -> list[str]:
+        """Get the complete lines so far
+
+        Args:
+            data: Next chunk of bytes
+            final: Whether this is the last chunk. Defaults to False.
+
+        Returns:
+            List of lines
+        """
+        text = self._pending + self._decoder.decode(data, final)
+        lines = StringIO(text, newline="").readlines()
+        # A line ending in \r may continue with \n in the next chunk
+        if not final and lines and not lines[-1].endswith("\n"):
+            self._pending = lines.pop()
+        else:
+            self._pending = ""
+        return lines
+
+
+def iter_queue(queue: asyncio.Queue, loop: asyncio.AbstractEventLoop) -> Iterator[Any]:
+    """Iterate from a thread over the items put in an asyncio queue until
+    None. An exception put in the queue is raised.
+
+    Args:
+        queue: Queue of the event loop
+        loop: Event loop running in another thread
+
+    Returns:
+        Iterator over items
+    """
+    while True:
+        item = asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+"""Buffered CSV writer of rows given as positional values"""
+
+import csv
+import gzip
+from codecs import BOM_UTF8
+from collections.abc import Iterable, Sequence
+from io import StringIO
+from pathlib import Path
+from typing import BinaryIO
+
+
+def _open_gzip(path: Path | str) -> gzip.GzipFile:
+    # mtime of 0 so that the same rows always give the same bytes. Level 6 (the
+    # zlib default) rather than GzipFile's 9 which is slower for little gain.
+    return gzip.GzipFile(path, "wb", compresslevel=6, mtime=0)
+
+
+class RowWriter:
+    """Writes rows of values to a UTF-8 (with BOM) CSV file, optionally gzip
+    compressed. Rows are held until buffer_rows have been added, formatted in
+    one writerows call and written to the file in chunks of chunk_size bytes.
+    If buffer_rows is 0, each row is instead formatted as it is added and the
+    text written once it reaches chunk_size, which holds less in memory than
+    the values of the rows.
+
+    Rows are sequences of values in the order of fields. If that differs from
+    headers, the values are rearranged into header order with any header that
+    is not in fields left empty. None values are written as empty strings.
+    The number of rows written, excluding the header and anything passed to
+    write_bytes, is in rows. If gzip_path is given, a gzip compressed copy of
+    the output is written there at the same time.
+
+    If resume_at is given, an existing uncompressed output is continued from
+    that position with anything after it discarded, eg. the rows of a country
+    that was being written when a run failed. No header is written and the
+    gzip compressed copy is rebuilt from the existing output.
+
+    Args:
+        path: Path of output file
+        headers: Headers of output file
+        fields: Order of values in rows. Defaults to None (same as headers).
+        compress: Whether to gzip the output. Defaults to False.
+        buffer_rows: Rows to hold before writing, 0 to hold text. Defaults to 10000.
+        chunk_size: Size in bytes of each write to the file. Defaults to 1048576.
+        gzip_path: Path of gzip compressed copy. Defaults to None (no copy).
+        resume_at: Position from which to continue output. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        path: Path | str,
+        headers: Sequence[str],
+        fields: Sequence[str] | None = None,
+        compress: bool = False,
+        buffer_rows: int = 10000,
+        chunk_size: int = 1048576,
+        gzip_path: Path | str | None = None,
+        resume_at: int | None = None,
+    ):
+        if compress and resume_at is not None:
+            raise ValueError("Cannot resume a compressed output!")
+        self.path = Path(path)
+        if fields is None or list(fields) == list(headers):
+            self._indices = None
+        else:
+            fields = list(fields)
+            self._indices = [
+                fields.index(header) if header in fields else None for header in headers
+            ]
+        self._buffer_rows = buffer_rows
+        self._chunk_size = chunk_size
+        self._compress = compress
+        self._gzip_path = Path(gzip_path) if gzip_path else None
+        self._fps = [self._open(self.path, compress, resume_at is not None)]
+        if self._gzip_path:
+            self._fps.append(self._open(self._gzip_path, True))
+        self._rows = []
+        self._text = StringIO()
+        self._writer = csv.writer(self._text)
+        self._position = 0
+        self._rows_written = 0
+        if resume_at is None:
+            self.write_bytes(BOM_UTF8)
+            self._writer.writerow(headers)
+            self._write_text()
+        else:
+            self._resume(resume_at)
+
+    @staticmethod
+    def _open(path: Path, compress: bool, existing: bool = False) -> BinaryIO:
+        if compress:
+            return _open_gzip(path)
+        return open(path, "r+b" if existing else "wb", buffering=0)
+
+    def _resume(self, position: int) -> None:
+        fp = self._fps[0]
+        fp.truncate(position)
+        fp.seek(position)
+        if self._gzip_path:
+            with open(self.path, "rb") as existing:
+                while chunk := existing.read(self._chunk_size):
+                    self._fps[1].write(chunk)
+        self._position = position
+
+    def truncate(self, position: int, rows: int) -> None:
+        """Discard everything after position in the uncompressed output, eg.
+        the rows of a country that could not be read. Any rows held are
+        dropped and the gzip compressed copy is rebuilt from the output that is
+        kept.
+
+        Args:
+            position: Position in the output to keep up to
+            rows: Number of rows written up to position
+        """
+        if self._compress:
+            raise ValueError("Cannot truncate a compressed output!")
+        self._rows = []
+        self._text.seek(0)
+        self._text.truncate()
+        for fp in self._fps:
+            fp.close()
+        self._fps = [self._open(self.path, False, True)]
+        if self._gzip_path:
+            self._fps.append(self._open(self._gzip_path, True))
+        self._resume(position)
+        self._rows_written = rows
+
+    @property
+    def paths(self) -> list[Path]:
+        """Paths of the output and its gzip compressed copy if any"""
+        if self._gzip_path:
+            return [self.path, self._gzip_path]
+        return [self.path]
+
+    def _write_text(self) -> None:
+        data = self._text.getvalue().encode("utf-8")
+        self._text.seek(0)
+        self._text.truncate()
+        self.write_bytes(data)
+
+    def _reorder(self, rows: Iterable[Sequence]) -> Iterable[Sequence]:
+        if not self._indices:
+            return rows
+        return [
+            [row[i] if i is not None else "" for i in self._indices] for row in rows
+        ]
+
+    def _write_rows(self) -> None:
+        if not self._rows:
+            # Text of rows formatted as they were added
+            if self._text.tell():
+                self._write_text()
+            return
+        self._writer.writerows(self._reorder(self._rows))
+        self._rows_written += len(self._rows)
+        self._rows = []
+        self._write_text()
+
+    def _format_rows(self, rows: Sequence[Sequence]) -> None:
+        self._writer.writerows(self._reorder(rows))
+        self._rows_written += len(rows)
+        if self._text.tell() >= self._chunk_size:
+            self._write_text()
+
+    @property
+    def rows(self) -> int:
+        return self._rows_written + len(self._rows)
+
+    def writerow(self, row: Sequence) -> None:
+        if not self._buffer_rows:
+            if self._indices:
+                row = [row[i] if i is not None else "" for i in self._indices]
+            self._writer.writerow(row)
+            self._rows_written += 1
+            if self._text.tell() >= self._chunk_size:
+                self._write_text()
+            return
+        self._rows.append(row)
+        if len(self._rows) >= self._buffer_rows:
+            self._write_rows()
+
+    def writerows(self, rows: Iterable[Sequence]) -> None:
+        if not self._buffer_rows:
+            self._format_rows(list(rows))
+            return
+        self._rows.extend(rows)
+        if len(self._rows) >= self._buffer_rows:
+            self._write_rows()
+
+    def write_formatted(self, text: str, rows: int) -> None:
+        """Write rows already formatted as CSV text in the order of headers,
+        eg. by the columnar transform
+
+        Args:
+            text: Text of rows
+            rows: Number of rows in text
+        """
+        self.write_bytes(text.encode("utf-8"))
+        self._rows_written += rows
+
+    def write_bytes(self, data: bytes) -> None:
+        """Write already formatted CSV rows, eg. copied from another output"""
+        self._write_rows()
+        view = memoryview(data)
+        for start in range(0, len(view), self._chunk_size):
+            chunk = view[start : start + self._chunk_size]
+            for fp in self._fps:
+                fp.write(chunk)
+        self._position += len(view)
+
+    def tell(self) -> int:
+        """Position in the uncompressed output once held rows are written"""
+        self._write_rows()
+        return self._position
+
+    def flush(self) -> None:
+        self._write_rows()
+        for fp in self._fps:
+            fp.flush()
+
+    def close(self) -> None:
+        self._write_rows()
+        for fp in self._fps:
+            fp.close()
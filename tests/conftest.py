@@ -1,13 +1,29 @@
+import json
+from collections.abc import Callable, Sequence
+from glob import glob
 from os.path import join
+from typing import NamedTuple
 
 import pytest
 from hdx.api.configuration import Configuration
 from hdx.api.locations import Locations
+from hdx.api.utilities.hdx_error_handler import HDXErrorHandler
 from hdx.data.dataset import Dataset
 from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
+from hdx.utilities.retriever import Retrieve
 from hdx.utilities.useragent import UserAgent
 
+from hdx.scraper.wfp_rainfall.pipeline import Pipeline
+
+
+class PipelineRun(NamedTuple):
+    pipeline: Pipeline
+    errors: dict
+    report: dict | None
+
 
 @pytest.fixture(scope="session")
 def fixtures_dir():
@@ -25,11 +41,14 @@ def config_dir(fixtures_dir):
 
 
 @pytest.fixture(scope="function")
-def read_dataset(monkeypatch, input_dir):
-    def read_from_hdx(dataset_name):
-        return Dataset.load_from_json(join(input_dir, f"dataset-{dataset_name}.json"))
+def search_datasets(monkeypatch, input_dir):
+    def search_in_hdx(query="*:*", configuration=None, page_size=1000, **kwargs):
+        return [
+            Dataset.load_from_json(path)
+            for path in sorted(glob(join(input_dir, "dataset-*.json")))
+        ]
 
-    monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(read_from_hdx))
+    monkeypatch.setattr(Dataset, "search_in_hdx", staticmethod(search_in_hdx))
 
 
 @pytest.fixture(scope="session")
@@ -59,3 +78,43 @@ def configuration(config_dir):
         "name": "approved",
     }
     return Configuration.read()
+
+
+@pytest.fixture(scope="function")
+def run_pipeline(configuration, input_dir) -> Callable[..., PipelineRun]:
+    """Get a function that runs download_data on saved country files with
+    output to tempdir. Keyword arguments are passed to Pipeline."""
+
+    def run_pipeline(
+        tempdir: str,
+        today: str = "2025-07-08",
+        saved_dir: str | None = None,
+        countries: Sequence[str] = ("MOZ", "AFG"),
+        **kwargs,
+    ) -> PipelineRun:
+        with HDXErrorHandler() as error_handler:
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=saved_dir or input_dir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                pipeline = Pipeline(
+                    configuration,
+                    retriever,
+                    tempdir,
+                    error_handler,
+                    parse_date(today),
+                    **kwargs,
+                )
+                pipeline.download_data(list(countries))
+                report = None
+                if kwargs.get("report"):
+                    with open(pipeline.save_report()) as fp:
+                        report = json.load(fp)
+                return PipelineRun(pipeline, error_handler.shared_errors, report)
+
+    return run_pipeline
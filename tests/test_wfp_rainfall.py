@@ -1,86 +1,1068 @@
-from os.path import join
+import asyncio
+import csv
+import gzip
+import hashlib
+import json
+import pickle
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from os import listdir, makedirs
+from os.path import getsize, join
+from pathlib import Path
+from shutil import copytree, rmtree
+from time import sleep
 
+import pytest
 from hdx.api.utilities.hdx_error_handler import HDXErrorHandler
+from hdx.location.adminlevel import AdminLevel
 from hdx.utilities.compare import assert_files_same
 from hdx.utilities.dateparse import parse_date
-from hdx.utilities.downloader import Download
+from hdx.utilities.downloader import Download, DownloadError
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
 
-from hdx.scraper.wfp_rainfall.pipeline import Pipeline
+from hdx.scraper.wfp_rainfall.cache import DownloadCache
+from hdx.scraper.wfp_rainfall.dekads import DekadTable
+from hdx.scraper.wfp_rainfall.diagnostics import Diagnostics
+from hdx.scraper.wfp_rainfall.pcodes import PcodeIndex
+from hdx.scraper.wfp_rainfall.pipeline import (
+    Pipeline,
+    _init_worker,
+    _transform_in_worker,
+)
+from hdx.scraper.wfp_rainfall.reader import get_cutoff, prefilter_rows
+from hdx.scraper.wfp_rainfall.streaming import LineSplitter
+from hdx.scraper.wfp_rainfall.writer import RowWriter
+
+
+def write_repeated(path: str, new_path: str, end: bytes = b"") -> None:
+    """Write a copy of a rainfall file with its rows repeated so that some
+    are transformed before anything that goes wrong at its end"""
+    with open(path, "rb") as fp:
+        header, *rows = fp.readlines()
+    with open(new_path, "wb") as fp:
+        fp.write(header)
+        fp.writelines(rows * 100)
+        fp.write(end)
 
 
 class TestWFPRainfall:
+    def test_discover_sources(self, configuration, search_datasets):
+        with HDXErrorHandler() as error_handler:
+            wfp_rainfall = Pipeline(
+                configuration,
+                None,
+                "",
+                error_handler,
+                parse_date("2025-07-01"),
+            )
+            sources = wfp_rainfall.discover_sources()
+            assert sorted(sources) == ["AFG", "MOZ"]
+            assert sources["MOZ"] == (
+                "MOZ",
+                "moz-rainfall-subnational",
+                "f4565cc3-99aa-4dd7-b74f-daae26e1335f",
+                "ff1b6836-e6ae-4f8b-8cd0-c21324a7d340",
+                "https://demo.data-humdata-org.ahconu.org/dataset/f4565cc3-99aa-4dd7-b74f-daae26e1335f/resource/ff1b6836-e6ae-4f8b-8cd0-c21324a7d340/download/moz-rainfall-adm2-5ytd.csv",
+                "2025-03-11T13:19:45.124882",
+            )
+
+    def test_dekad_table(self):
+        dekad_table = DekadTable(parse_date("2025-07-01"))
+        dekad_dates = dekad_table.get("2024-02-21")
+        assert dekad_dates.start_date_iso == "2024-02-21"
+        assert dekad_dates.end_date_iso == "2024-02-29"
+        assert dekad_dates.ytd == 2
+        assert dekad_table.get("2024-02-21") is dekad_dates
+        dekad_dates = dekad_table.get("2025-03-11")
+        assert dekad_dates.end_date == parse_date("2025-03-20")
+        assert dekad_dates.ytd == 1
+
+    def test_prefilter_rows(self):
+        cutoff = get_cutoff(parse_date("2025-07-08"))
+        assert cutoff == "2024-07-07"
+        content = (
+            "date,adm_level,PCODE,n_pixels\r\n"
+            "2024-01-01,1,MZ01,1.0\r\n"
+            "2024-01-01,2,MZ0101,2.0\r\n"
+            "\r\n"
+            '2025-01-01,2,"MZ,0102",3.0\r\n'
+            "2025-01-11,1\r\n"
+        )
+        dates = set()
+        headers, rows = prefilter_rows(StringIO(content, None), dates, cutoff, False)
+        assert headers == ["date", "adm_level", "PCODE", "n_pixels"]
+        assert list(rows) == [
+            ["2024-01-01", "1", "MZ01", "1.0"],
+            ["2025-01-01", "2", "MZ,0102", "3.0"],
+            ["2025-01-11", "1", "", ""],
+        ]
+        assert dates == {"2024-01-01", "2025-01-01", "2025-01-11"}
+        dates = set()
+        _, rows = prefilter_rows(StringIO(content, None), dates, cutoff, True)
+        assert [row[0] for row in rows] == ["2024-01-01", "2025-01-11"]
+        assert dates == {"2024-01-01", "2025-01-01", "2025-01-11"}
+
+    def test_row_writer(self):
+        with temp_dir(
+            "Test_wfp_rainfall_writer",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            # Rows held as values or, with buffer_rows 0, as formatted text
+            for compress, buffer_rows in ((False, 2), (True, 2), (False, 0)):
+                path = join(tempdir, f"output_{compress}_{buffer_rows}.csv")
+                writer = RowWriter(
+                    path,
+                    ["a", "c", "b"],
+                    ("a", "b"),
+                    compress=compress,
+                    buffer_rows=buffer_rows,
+                    chunk_size=4,
+                )
+                assert writer.tell() == 10
+                writer.writerow((1, None))
+                writer.writerows([("x,y", 2), (3, "z")])
+                assert writer.tell() == 31
+                assert writer.rows == 3
+                writer.write_bytes(b"4,,5\r\n")
+                writer.close()
+                if compress:
+                    with gzip.open(path, "rb") as fp:
+                        content = fp.read()
+                else:
+                    with open(path, "rb") as fp:
+                        content = fp.read()
+                assert content == (
+                    b'\xef\xbb\xbfa,c,b\r\n1,,\r\n"x,y",,2\r\n3,,z\r\n4,,5\r\n'
+                )
+
+    def test_diagnostics(self):
+        with HDXErrorHandler() as error_handler:
+            diagnostics = Diagnostics(error_handler)
+            for _ in range(3):
+                diagnostics.add("PCode unknown XX999->''", "warning", 3)
+            diagnostics.add("Version unknown None", count=3)
+            assert diagnostics.flush("moz-rainfall-subnational") == [
+                ["PCode unknown XX999->''", "warning", 9],
+                ["Version unknown None", "error", 3],
+            ]
+            diagnostics.add("Could not find resource", "warning")
+            diagnostics.flush("afg-rainfall-subnational")
+            assert diagnostics.counts == {}
+            assert error_handler.shared_errors["warning"] == {
+                "Rainfall - afg-rainfall-subnational": {
+                    "Rainfall - afg-rainfall-subnational - Could not find resource"
+                },
+                "Rainfall - moz-rainfall-subnational": {
+                    "Rainfall - moz-rainfall-subnational - "
+                    "PCode unknown XX999->'' (9 rows)"
+                },
+            }
+            assert diagnostics.get_summary() == [
+                {
+                    "category": "Rainfall",
+                    "dataset": "moz-rainfall-subnational",
+                    "message": "PCode unknown XX999->''",
+                    "message_type": "warning",
+                    "count": 9,
+                },
+                {
+                    "category": "Rainfall",
+                    "dataset": "moz-rainfall-subnational",
+                    "message": "Version unknown None",
+                    "message_type": "error",
+                    "count": 3,
+                },
+                {
+                    "category": "Rainfall",
+                    "dataset": "afg-rainfall-subnational",
+                    "message": "Could not find resource",
+                    "message_type": "warning",
+                    "count": 1,
+                },
+            ]
+
+    def test_pcode_index(self, configuration, input_dir, monkeypatch):
+        with temp_dir(
+            "Test_wfp_rainfall_pcodes",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=input_dir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                pcode_index = PcodeIndex(retriever, tempdir)
+                pcode_index.setup()
+                assert pcode_index.resolve("MOZ", 2, "MZ0101") == (
+                    ("MZ01", "MZ0101"),
+                    ("Cabo Delgado", "Ancuabe"),
+                    (),
+                )
+                assert pcode_index.resolve("MOZ", 2, "MZ00101") == (
+                    ("MZ01", "MZ0101"),
+                    ("Cabo Delgado", "Ancuabe"),
+                    ("PCode length MZ00101->MZ0101",),
+                )
+                pcode_index.save()
+
+                pcode_index = PcodeIndex(retriever, tempdir)
+                pcode_index.setup()
+                assert pcode_index.resolve("AFG", 1, "AF01") == (
+                    ("AF01", ""),
+                    ("Kabul", ""),
+                    (),
+                )
+                assert pcode_index.resolve("MOZ", 2, "MZ00101") == (
+                    ("MZ01", "MZ0101"),
+                    ("Cabo Delgado", "Ancuabe"),
+                    ("PCode length MZ00101->MZ0101",),
+                )
+                assert pcode_index.resolve("MOZ", 2, "XX999") == (
+                    ("", ""),
+                    ("", ""),
+                    ("PCode unknown XX999->''",),
+                )
+
+                # Workers get the AdminLevel objects rather than set them up
+                pcode_index.setup_admins()
+                worker_index = pickle.loads(pickle.dumps(pcode_index))
+
+                def fail_setup(self, *args, **kwargs):
+                    raise AssertionError("AdminLevel set up in worker")
+
+                monkeypatch.setattr(AdminLevel, "setup_from_iterable", fail_setup)
+                assert worker_index.resolve("MOZ", 2, "MZ00102") == (
+                    ("MZ01", "MZ0102"),
+                    ("Cabo Delgado", "Balama"),
+                    ("PCode length MZ00102->MZ0102",),
+                )
+
     def test_wfp_rainfall(
-        self, configuration, fixtures_dir, input_dir, config_dir, read_dataset
+        self, fixtures_dir, config_dir, search_datasets, run_pipeline
     ):
-        with HDXErrorHandler() as error_handler:
+        with temp_dir(
+            "Test_wfp_rainfall",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            wfp_rainfall = run_pipeline(tempdir, "2025-07-01").pipeline
+            dataset = wfp_rainfall.generate_global_dataset()
+            dataset.update_from_yaml(path=join(config_dir, "hdx_dataset_static.yaml"))
+            assert dataset == {
+                "name": "hdx-hapi-rainfall",
+                "title": "HDX HAPI - Climate: Rainfall",
+                "tags": [
+                    {
+                        "name": "climate-weather",
+                        "vocabulary_id": "b891512e-9516-4bf5-962a-7a289772a2a1",
+                    },
+                ],
+                "groups": [{"name": "world"}],
+                "dataset_date": "[2021-01-01T00:00:00 TO 2025-03-10T23:59:59]",
+                "license_id": "cc-by",
+                "methodology": "Registry",
+                "caveats": "This dataset is refreshed every week, but the source datasets may have different update schedules. Please refer to the [source datasets](https://data.humdata.org/dataset/?dataseries_name=WFP+-+Rainfall+Indicators+at+Subnational+Level) to verify their specific update frequency.",
+                "dataset_source": "Climate Hazards Center UC Santa Barbara & WFP",
+                "package_creator": "HDX Data Systems Team",
+                "private": False,
+                "maintainer": "aa13de36-28c5-47a7-8d0b-6d7c754ba8c8",
+                "owner_org": "hdx-hapi",
+                "data_update_frequency": 14,
+                "notes": "This dataset contains data obtained from the\n[HDX Humanitarian API](https://hapi.humdata.org/) (HDX HAPI),\nwhich provides standardized humanitarian indicators designed\nfor seamless interoperability from multiple sources.\nThe data facilitates automated workflows and visualizations\nto support humanitarian decision making.\nFor more information, please see the HDX HAPI\n[landing page](https://data.humdata.org/hapi)\nand\n[documentation](https://hdx-hapi.readthedocs.io/en/latest/).\n\n"
+                "Warnings typically indicate corrections have been made to\nthe data or show things to look out for. Rows with only warnings\nare considered complete, and are made available via the API.\nErrors usually mean that the data is incomplete or unusable.\nRows with any errors are not present in the API but are included\nhere for transparency.\n\n"
+                "Note that this dataset only contains admin one data for non\nHRP/GHO countries. For all other countries both admin one and two\nare present (where available). For the time being only the current\nyear of rainfall data is included due to the size of the data.\nFor the full set of data, please visit the\n[source datasets](https://data.humdata.org/dataset/?dataseries_name=WFP+-+Rainfall+Indicators+at+Subnational+Level).\n",
+                "subnational": "1",
+                "dataset_preview": "no_preview",
+            }
+            resources = dataset.get_resources()
+            assert len(resources) == 5
+            ytd1_resource = next(
+                r
+                for r in resources
+                if r["name"] == "Global Climate: Rainfall (1 year(s) ago)"
+            )
+            assert ytd1_resource == {
+                "name": "Global Climate: Rainfall (1 year(s) ago)",
+                "description": "Rainfall data (1 year(s) ago) from HDX HAPI, please see [the documentation](https://hdx-hapi.readthedocs.io/en/latest/data_usage_guides/climate/#rainfall) for more information",
+                "p_coded": True,
+                "format": "csv",
+            }
+            assert_files_same(
+                join(fixtures_dir, "hdx_hapi_rainfall_global_1yr.csv"),
+                join(tempdir, "hdx_hapi_rainfall_global_1yr.csv"),
+            )
+
+    def test_incremental_refresh(
+        self, fixtures_dir, search_datasets, monkeypatch, run_pipeline
+    ):
+        with temp_dir(
+            "Test_wfp_rainfall_incremental",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            state_dir = join(tempdir, "state")
+            first_dir = join(tempdir, "first")
+            second_dir = join(tempdir, "second")
+            makedirs(first_dir)
+            makedirs(second_dir)
+            first = run_pipeline(first_dir, state_dir=state_dir).pipeline
+
+            def fail_download(self):
+                raise AssertionError("Unchanged country was downloaded")
+
+            with monkeypatch.context() as m:
+                m.setattr(Pipeline, "_get_retriever", fail_download)
+                second = run_pipeline(second_dir, state_dir=state_dir).pipeline
+            assert min(second.dates) == min(first.dates)
+            assert max(second.dates) == max(first.dates)
+            for ytd in range(1, 6):
+                assert_files_same(
+                    join(first_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                    join(second_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                )
+            assert_files_same(
+                join(fixtures_dir, "hdx_hapi_rainfall_global_1yr.csv"),
+                join(second_dir, "hdx_hapi_rainfall_global_1yr.csv"),
+            )
+
+            # Previous outputs left part copied by a run that failed while
+            # saving the manifest are not reused
+            previous_output = join(
+                state_dir, "previous", "hdx_hapi_rainfall_global_5yr.csv"
+            )
+            with open(previous_output, "r+b") as fp:
+                fp.truncate(fp.seek(0, 2) // 2)
+            third_dir = join(tempdir, "third")
+            makedirs(third_dir)
+            _, _, report = run_pipeline(third_dir, state_dir=state_dir, report=True)
+            assert not any(
+                counts.get("reused") for counts in report["countries"].values()
+            )
+            for ytd in range(1, 6):
+                assert_files_same(
+                    join(first_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                    join(third_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                )
+
+    def test_columnar_engine(
+        self, configuration, input_dir, search_datasets, monkeypatch, run_pipeline
+    ):
+        pytest.importorskip("numpy")
+
+        with temp_dir(
+            "Test_wfp_rainfall_columnar",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            row_dir = join(tempdir, "row")
+            columnar_dir = join(tempdir, "columnar")
+            makedirs(row_dir)
+            makedirs(columnar_dir)
+            row, row_errors, _ = run_pipeline(row_dir)
+            columnar, columnar_errors, _ = run_pipeline(columnar_dir, engine="columnar")
+            assert columnar.dates == row.dates
+            assert columnar_errors == row_errors
+            assert sorted(columnar.data) == sorted(row.data)
+            for ytd in row.data:
+                assert_files_same(
+                    join(row_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                    join(columnar_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                )
+
+            # Lines that the columnar engine cannot read from the positions of
+            # their commas, read in small chunks
+            monkeypatch.setitem(configuration, "columnar_chunk_size", 200)
+            saved_dir = join(tempdir, "saved")
+            copytree(input_dir, saved_dir)
+            moz_path = join(saved_dir, "download-moz-rainfall-adm2-5ytd.csv")
+            with open(moz_path, newline="") as fp:
+                header, *lines = fp.read().splitlines()
+            lines += [
+                "",
+                ",,,,,,,,,,,,,,",
+                "2025-02-21,2,,MZ0101,166.0,88.3,84.7,,236.8,717.7,751.2,103.9,"
+                "122.5,95.5,draft",
+                "2022-02-21,2,1010505,MZ0101,166.0,88.3,84.7,291.3,236.8,717.7,"
+                "751.2,103.9,122.5,95.5,final",
+                "2025-02-11,1,900948,MZ01,2588.0,53.3,86.4,127.5",
+                "2025-02-01,1,900948,MZ01,2588.0,53.3,86.4,127.5,226.2,166.1,"
+                "321.1,63.8,57.3,52.4,final,extra",
+            ]
+            with open(moz_path, "w", newline="") as fp:
+                fp.write("\ufeff" + "\r\n".join([header, *lines]) + "\r\n")
+            afg_path = join(saved_dir, "download-afg-rainfall-adm1-5ytd.csv")
+            with open(afg_path, "a") as fp:
+                fp.write(
+                    '2025-02-01,1,12345,"AF01",100.0,5.0,6.0,15.0,18.0,45.0,55.0,'
+                    "83.3,83.3,81.8,final\n"
+                )
+            for engine, engine_dir in (("row", row_dir), ("columnar", columnar_dir)):
+                rmtree(engine_dir)
+                makedirs(engine_dir)
+            row, row_errors, row_report = run_pipeline(
+                row_dir, saved_dir=saved_dir, report=True
+            )
+            columnar, columnar_errors, columnar_report = run_pipeline(
+                columnar_dir, saved_dir=saved_dir, engine="columnar", report=True
+            )
+            assert columnar.dates == row.dates
+            assert columnar_errors == row_errors
+            assert columnar_report["countries"] == row_report["countries"]
+            assert row_report["countries"]["MOZ"]["read"] == 10
+            for name in row.get_outputs():
+                assert_files_same(join(row_dir, name), join(columnar_dir, name))
+
+    def test_sharded_transform(
+        self, configuration, input_dir, search_datasets, run_pipeline
+    ):
+        with temp_dir(
+            "Test_wfp_rainfall_sharded",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            single_dir = join(tempdir, "single")
+            sharded_dir = join(tempdir, "sharded")
+            makedirs(single_dir)
+            makedirs(sharded_dir)
+            single, single_errors, single_report = run_pipeline(single_dir, report=True)
+            sharded, sharded_errors, sharded_report = run_pipeline(
+                sharded_dir, processes=2, report=True
+            )
+            assert sharded.dates == single.dates
+            assert sharded_errors == single_errors
+            assert sorted(sharded.data) == sorted(single.data)
+            assert single_report["totals"] == {
+                "file_bytes": 1387,
+                "read": 11,
+                "kept": 11,
+                "written": 33,
+            }
+            assert sharded_report["countries"] == single_report["countries"]
+            assert single_report["messages"] == []
+            assert sharded_report["messages"] == single_report["messages"]
+            assert sharded_report["outputs"] == single_report["outputs"]
+            assert "transform" in single_report["stages"]
+            assert "merge" in sharded_report["stages"]
+            for ytd in single.data:
+                assert_files_same(
+                    join(single_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                    join(sharded_dir, f"hdx_hapi_rainfall_global_{ytd}yr.csv"),
+                )
+
+            # A country that fails in a worker leaves nothing in the worker's
+            # shard files for the next country it transforms
+            bad_path = join(tempdir, "bad.csv")
+            write_repeated(
+                join(input_dir, "download-moz-rainfall-adm2-5ytd.csv"),
+                bad_path,
+                b"\xff\n",
+            )
+            shard_root = join(tempdir, "shards")
+            makedirs(shard_root)
+            _init_worker(
+                configuration,
+                shard_root,
+                parse_date("2025-07-08"),
+                "row",
+                single._pcode_index,
+                False,
+            )
+            with pytest.raises(UnicodeDecodeError):
+                _transform_in_worker(
+                    single._sources["MOZ"], bad_path, *Pipeline._get_hrp_gho("MOZ")
+                )
+            shard = _transform_in_worker(
+                single._sources["AFG"],
+                join(input_dir, "download-afg-rainfall-adm1-5ytd.csv"),
+                *Pipeline._get_hrp_gho("AFG"),
+            )
+            assert (
+                shard.counts["written"]
+                == (single_report["countries"]["AFG"]["written"])
+            )
+            for path, start, end in shard.segments.values():
+                with open(path, "rb") as fp:
+                    fp.seek(start)
+                    rows = fp.read(end - start).decode("utf-8").splitlines()
+                assert {row[:3] for row in rows} == {"AFG"}
+            assert sorted(listdir(shard_root)) == [Path(shard.folder).parent.name]
+
+    def test_malformed_file(self, input_dir, search_datasets, run_pipeline):
+        with temp_dir(
+            "Test_wfp_rainfall_malformed",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            saved_dir = join(tempdir, "input")
+            copytree(input_dir, saved_dir)
+            write_repeated(
+                join(input_dir, "download-moz-rainfall-adm2-5ytd.csv"),
+                join(saved_dir, "download-moz-rainfall-adm2-5ytd.csv"),
+                b"\xff\n",
+            )
+            # MOZ rows written before the invalid byte is read are discarded
+            # from outputs that AFG was written to and from those only MOZ was
+            for history in (False, True):
+                expected_dir = join(tempdir, f"expected_{history}")
+                malformed_dir = join(tempdir, f"malformed_{history}")
+                makedirs(expected_dir)
+                makedirs(malformed_dir)
+                expected = run_pipeline(
+                    expected_dir,
+                    countries=("AFG",),
+                    history=history,
+                    extra_formats=("csv.gz",),
+                ).pipeline
+                malformed, errors, _ = run_pipeline(
+                    malformed_dir,
+                    saved_dir=saved_dir,
+                    countries=("AFG", "MOZ"),
+                    history=history,
+                    extra_formats=("csv.gz",),
+                )
+                assert errors["error"] == {
+                    "Rainfall - moz-rainfall-subnational": {
+                        "Rainfall - moz-rainfall-subnational - Could not read resource"
+                    }
+                }
+                assert sorted(listdir(malformed_dir)) == sorted(listdir(expected_dir))
+                for name in expected.get_outputs():
+                    with open(join(expected_dir, name), "rb") as fp:
+                        content = fp.read()
+                    with open(join(malformed_dir, name), "rb") as fp:
+                        assert fp.read() == content
+
+    def test_history_mode(
+        self,
+        configuration,
+        config_dir,
+        input_dir,
+        search_datasets,
+        monkeypatch,
+        run_pipeline,
+    ):
+        with temp_dir(
+            "Test_wfp_rainfall_history",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            saved_dir = join(tempdir, "input")
+            copytree(input_dir, saved_dir)
+            # Admin 2 row from 4 years ago that is only kept in history mode
+            with open(
+                join(saved_dir, "download-moz-rainfall-adm2-5ytd.csv"), "a"
+            ) as fp:
+                fp.write(
+                    "2022-01-01,2,1010505,MZ0101,166.0,88.3,84.7,291.3,236.8,"
+                    "717.7,751.2,103.9,122.5,95.5,final\n"
+                )
+            regions_dir = join(tempdir, "regions")
+            makedirs(regions_dir)
+            wfp_rainfall = run_pipeline(
+                regions_dir, saved_dir=saved_dir, history=True
+            ).pipeline
+            assert wfp_rainfall.data == {}
+            assert sorted(wfp_rainfall.partitions) == [
+                (ytd, group, 1) for ytd in range(1, 6) for group in ("Africa", "Asia")
+            ]
+            with open(join(regions_dir, "hdx_hapi_rainfall_africa_4yr_1.csv")) as fp:
+                rows = fp.read().splitlines()
+            assert len(rows) == 7
+            assert rows[4].startswith(
+                "MOZ,Y,Y,Not provided,Not provided,MZ01,Cabo Delgado,MZ0101,Ancuabe,2"
+            )
+            dataset = wfp_rainfall.generate_global_dataset()
+            resources = dataset.get_resources()
+            assert len(resources) == 10
+            assert (
+                resources[0]["name"]
+                == "Climate: Rainfall Africa (1 year(s) ago) part 1"
+            )
+            dataset.update_from_yaml(path=join(config_dir, "hdx_dataset_static.yaml"))
+            dataset.update_from_yaml(
+                path=join(config_dir, "hdx_dataset_static_history.yaml")
+            )
+            assert "only the current year" not in dataset["notes"]
+            assert "Rainfall data of all years is" in dataset["notes"]
+            assert dataset["license_id"] == "cc-by"
+
+            # Both countries are low income so are in the same group but each
+            # part is full after one country
+            monkeypatch.setitem(
+                configuration, "history_group", "World Bank Income Level"
+            )
+            monkeypatch.setitem(configuration, "history_target_bytes", 1)
+            income_dir = join(tempdir, "income")
+            makedirs(income_dir)
+            wfp_rainfall = run_pipeline(
+                income_dir, saved_dir=saved_dir, history=True
+            ).pipeline
+            assert sorted(wfp_rainfall.partitions) == [
+                (ytd, "Low", part) for ytd in range(1, 6) for part in (1, 2)
+            ]
+            for ytd in range(1, 6):
+                for part, countryiso3 in ((1, "MOZ"), (2, "AFG")):
+                    path = join(income_dir, f"hdx_hapi_rainfall_low_{ytd}yr_{part}.csv")
+                    with open(path) as fp:
+                        rows = fp.read().splitlines()[1:]
+                    assert {row[:3] for row in rows} == {countryiso3}
+
+            # Nothing but the parts of every year is kept on disk, so the
+            # footprint is the size of the outputs, until they are deleted
+            # once uploaded
+            finish_country = Pipeline._finish_country
+            footprints = []
+
+            def measure_footprint(self, country_data, shard=None):
+                finish_country(self, country_data, shard)
+                for writer in self._writers.values():
+                    writer.flush()
+                outputs = self.get_outputs()
+                assert sorted(listdir(footprint_dir)) == sorted(outputs)
+                footprints.append(sum(getsize(path) for path in outputs.values()))
+
+            monkeypatch.setattr(Pipeline, "_finish_country", measure_footprint)
+            footprint_dir = join(tempdir, "footprint")
+            makedirs(footprint_dir)
+            wfp_rainfall = run_pipeline(
+                footprint_dir,
+                saved_dir=saved_dir,
+                history=True,
+                extra_formats=("csv.gz",),
+            ).pipeline
+            assert {ytd for ytd, _, _ in wfp_rainfall.partitions} == set(range(1, 6))
+            assert len(footprints) == 2
+            assert footprints[0] < footprints[1]
+            wfp_rainfall.delete_outputs()
+            assert listdir(footprint_dir) == []
+
+    def test_extra_formats(
+        self, configuration, fixtures_dir, search_datasets, monkeypatch, run_pipeline
+    ):
+        pq = pytest.importorskip("pyarrow.parquet")
+        monkeypatch.setitem(configuration, "parquet_row_group_rows", 4)
+        with temp_dir(
+            "Test_wfp_rainfall_formats",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            wfp_rainfall = run_pipeline(
+                tempdir, "2025-07-01", extra_formats=("csv.gz", "parquet")
+            ).pipeline
+            assert sorted(wfp_rainfall.get_outputs())[:3] == [
+                "hdx_hapi_rainfall_global_1yr.csv",
+                "hdx_hapi_rainfall_global_1yr.csv.gz",
+                "hdx_hapi_rainfall_global_1yr.parquet",
+            ]
+            expected_path = join(fixtures_dir, "hdx_hapi_rainfall_global_1yr.csv")
+            with open(expected_path, "rb") as fp:
+                expected = fp.read()
+            path = join(tempdir, "hdx_hapi_rainfall_global_1yr.csv.gz")
+            with gzip.open(path, "rb") as fp:
+                assert fp.read() == expected
+
+            parquet_file = pq.ParquetFile(
+                join(tempdir, "hdx_hapi_rainfall_global_1yr.parquet")
+            )
+            assert parquet_file.metadata.num_rows == 9
+            assert parquet_file.metadata.num_row_groups == 3
+            table = parquet_file.read()
+            assert str(table.schema.field("rainfall").type) == "double"
+            assert str(table.schema.field("admin_level").type) == "int8"
+            assert table.column("location_code").to_pylist() == [
+                "MOZ",
+                "MOZ",
+                "MOZ",
+                "MOZ",
+                "AFG",
+                "AFG",
+                "MOZ",
+                "MOZ",
+                "AFG",
+            ]
+            row = table.slice(4, 1).to_pylist()[0]
+            assert row["admin2_code"] == ""
+            assert row["number_pixels"] == 100
+
+            dataset = wfp_rainfall.generate_global_dataset()
+            resources = dataset.get_resources()
+            assert len(resources) == 15
+            assert [
+                (resource["name"], resource["format"]) for resource in resources[:3]
+            ] == [
+                ("Global Climate: Rainfall (1 year(s) ago)", "csv"),
+                (
+                    "Global Climate: Rainfall (1 year(s) ago) - gzipped CSV",
+                    "gz",
+                ),
+                (
+                    "Global Climate: Rainfall (1 year(s) ago) - Parquet",
+                    "parquet",
+                ),
+            ]
+
+            assert [
+                Path(resource.get_file_to_upload()).name for resource in resources[:3]
+            ] == [
+                "hdx_hapi_rainfall_global_1yr.csv",
+                "hdx_hapi_rainfall_global_1yr.csv.gz",
+                "hdx_hapi_rainfall_global_1yr.parquet",
+            ]
+
+            # Resources HDX did not upload as unchanged are in the run report
+            wfp_rainfall.set_upload_statuses(
+                {
+                    resource["name"]: status
+                    for resource, status in zip(resources, (3, 4, 2))
+                }
+            )
+            assert wfp_rainfall.unchanged == [
+                "Global Climate: Rainfall (1 year(s) ago)",
+                "Global Climate: Rainfall (1 year(s) ago) - gzipped CSV",
+            ]
+
+    def test_resume(self, search_datasets, monkeypatch, run_pipeline):
+        transformed = []
+        transform_country = Pipeline._transform_country
+
+        def run(tempdir, today, resume=False, fail_on=None):
+            def transform(self, source, path, hrp, gho):
+                transformed.append(source.countryiso3)
+                dates = transform_country(self, source, path, hrp, gho)
+                if source.countryiso3 == fail_on:
+                    raise RuntimeError("Timed out")
+                return dates
+
+            monkeypatch.setattr(Pipeline, "_transform_country", transform)
+            return run_pipeline(
+                tempdir,
+                today,
+                report=True,
+                extra_formats=("csv.gz",),
+                checkpoint=True,
+                resume=resume,
+            )
+
+        with temp_dir(
+            "Test_wfp_rainfall_resume",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            full_dir = join(tempdir, "full")
+            resumed_dir = join(tempdir, "resumed")
+            makedirs(full_dir)
+            makedirs(resumed_dir)
+            # Outputs of an earlier run are deleted by a run not resuming it
+            stale_path = join(full_dir, "hdx_hapi_rainfall_africa_1yr_3.csv")
+            with open(stale_path, "w") as fp:
+                fp.write("stale")
+            full, full_errors, full_report = run(full_dir, "2025-07-01")
+            assert transformed == ["MOZ", "AFG"]
+            assert sorted(listdir(full_dir)) == sorted(
+                [*full.get_outputs(), "checkpoint.jsonl", "run_report.json"]
+            )
+
+            transformed.clear()
+            with pytest.raises(RuntimeError):
+                run(resumed_dir, "2025-07-01", fail_on="AFG")
+            with open(join(resumed_dir, "checkpoint.jsonl")) as fp:
+                assert len(fp.readlines()) == 2
+
+            # Only the country that failed is transformed again, with the date
+            # of the failed run, and the outputs are the same as those of a
+            # run that did not fail
+            transformed.clear()
+            resumed, resumed_errors, resumed_report = run(
+                resumed_dir, "2025-07-02", resume=True
+            )
+            assert transformed == ["AFG"]
+            assert resumed_report["today"] == full_report["today"]
+            assert resumed_errors == full_errors
+            assert resumed_report["countries"] == full_report["countries"]
+            assert resumed.dates == full.dates
+            assert sorted(resumed.get_outputs()) == sorted(full.get_outputs())
+            for name in full.get_outputs():
+                with open(join(full_dir, name), "rb") as fp:
+                    expected = fp.read()
+                with open(join(resumed_dir, name), "rb") as fp:
+                    assert fp.read() == expected
+
+            resumed.delete_outputs()
+            assert listdir(resumed_dir) == ["run_report.json"]
+
+    def test_download_cache(self):
+        files = {"a.csv": b"a,b\r\n1,2\r\n", "b.csv": b"c,d\r\n3,4\r\n"}
+        requests = Counter()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                name = self.path[1:]
+                content = files[name]
+                etag = f'"{hashlib.md5(content).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    requests[(name, 304)] += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                requests[(name, 200)] += 1
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    content = gzip.compress(content)
+                    requests["gzip"] += 1
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        host, port = server.server_address
+        url = f"http://{host}:{port}"
+        try:
             with temp_dir(
-                "Test_wfp_rainfall",
+                "Test_wfp_rainfall_cache",
                 delete_on_success=True,
                 delete_on_failure=False,
             ) as tempdir:
                 with Download(user_agent="test") as downloader:
-                    retriever = Retrieve(
-                        downloader=downloader,
-                        fallback_dir=tempdir,
-                        saved_dir=input_dir,
-                        temp_dir=tempdir,
-                        save=False,
-                        use_saved=True,
-                    )
-                    wfp_rainfall = Pipeline(
-                        configuration,
-                        retriever,
-                        tempdir,
-                        error_handler,
-                        parse_date("2025-07-01"),
-                    )
-                    wfp_rainfall.download_data(["MOZ", "AFG"])
-                    dataset = wfp_rainfall.generate_global_dataset()
-                    dataset.update_from_yaml(
-                        path=join(config_dir, "hdx_dataset_static.yaml")
-                    )
-                    assert dataset == {
-                        "name": "hdx-hapi-rainfall",
-                        "title": "HDX HAPI - Climate: Rainfall",
-                        "tags": [
-                            {
-                                "name": "climate-weather",
-                                "vocabulary_id": "b891512e-9516-4bf5-962a-7a289772a2a1",
-                            },
-                        ],
-                        "groups": [{"name": "world"}],
-                        "dataset_date": "[2021-01-01T00:00:00 TO 2025-03-10T23:59:59]",
-                        "license_id": "cc-by",
-                        "methodology": "Registry",
-                        "caveats": "This dataset is refreshed every week, but the source datasets may have different update schedules. Please refer to the [source datasets](https://data.humdata.org/dataset/?dataseries_name=WFP+-+Rainfall+Indicators+at+Subnational+Level) to verify their specific update frequency.",
-                        "dataset_source": "Climate Hazards Center UC Santa Barbara & WFP",
-                        "package_creator": "HDX Data Systems Team",
-                        "private": False,
-                        "maintainer": "aa13de36-28c5-47a7-8d0b-6d7c754ba8c8",
-                        "owner_org": "hdx-hapi",
-                        "data_update_frequency": 14,
-                        "notes": "This dataset contains data obtained from the\n[HDX Humanitarian API](https://hapi.humdata.org/) (HDX HAPI),\nwhich provides standardized humanitarian indicators designed\nfor seamless interoperability from multiple sources.\nThe data facilitates automated workflows and visualizations\nto support humanitarian decision making.\nFor more information, please see the HDX HAPI\n[landing page](https://data.humdata.org/hapi)\nand\n[documentation](https://hdx-hapi.readthedocs.io/en/latest/).\n\n"
-                        "Warnings typically indicate corrections have been made to\nthe data or show things to look out for. Rows with only warnings\nare considered complete, and are made available via the API.\nErrors usually mean that the data is incomplete or unusable.\nRows with any errors are not present in the API but are included\nhere for transparency.\n\n"
-                        "Note that this dataset only contains admin one data for non\nHRP/GHO countries. For all other countries both admin one and two\nare present (where available). For the time being only the current\nyear of rainfall data is included due to the size of the data.\nFor the full set of data, please visit the\n[source datasets](https://data.humdata.org/dataset/?dataseries_name=WFP+-+Rainfall+Indicators+at+Subnational+Level).\n",
-                        "subnational": "1",
-                        "dataset_preview": "no_preview",
-                    }
-                    resources = dataset.get_resources()
-                    assert len(resources) == 5
-                    ytd1_resource = next(
-                        r
-                        for r in resources
-                        if r["name"] == "Global Climate: Rainfall (1 year(s) ago)"
-                    )
-                    assert ytd1_resource == {
-                        "name": "Global Climate: Rainfall (1 year(s) ago)",
-                        "description": "Rainfall data (1 year(s) ago) from HDX HAPI, please see [the documentation](https://hdx-hapi.readthedocs.io/en/latest/data_usage_guides/climate/#rainfall) for more information",
-                        "p_coded": True,
-                        "format": "csv",
+                    cache = DownloadCache(tempdir, 15)
+                    cache.load()
+                    path_a, cached = cache.download(downloader, f"{url}/a.csv")
+                    assert not cached
+                    assert path_a.read_bytes() == files["a.csv"]
+                    assert cache.download(downloader, f"{url}/a.csv") == (path_a, True)
+                    files["a.csv"] = b"a,b\r\n5,6\r\n"
+                    assert cache.download(downloader, f"{url}/a.csv") == (path_a, False)
+                    assert path_a.read_bytes() == files["a.csv"]
+                    cache.save()
+
+                    # Files used in a previous run are evicted when the cache is
+                    # full but those used in this run are kept until it ends
+                    cache = DownloadCache(tempdir, 15)
+                    cache.load()
+                    path_b, cached = cache.download(downloader, f"{url}/b.csv")
+                    assert not cached
+                    assert not path_a.exists()
+                    assert cache.download(downloader, f"{url}/a.csv") == (path_a, False)
+                    assert cache.download(downloader, f"{url}/b.csv") == (path_b, True)
+                    assert path_a.exists()
+                    cache.save()
+                    assert not path_a.exists()
+                    assert path_b.exists()
+                    assert requests == {
+                        ("a.csv", 200): 3,
+                        ("a.csv", 304): 1,
+                        ("b.csv", 200): 1,
+                        ("b.csv", 304): 1,
+                        "gzip": 4,
                     }
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_asynchronous_mode(
+        self, configuration, input_dir, search_datasets, monkeypatch, run_pipeline
+    ):
+        data = '\ufeffa,b\r\nx,"é\r\nq"\nlast\rcr\r\nend'.encode()
+        expected = ["a,b\r\n", 'x,"é\r\n', 'q"\n', "last\r", "cr\r\n", "end"]
+        for size in (1, 2, 5):
+            splitter = LineSplitter()
+            lines = []
+            for start in range(0, len(data), size):
+                lines.extend(splitter.split(data[start : start + size]))
+            lines.extend(splitter.split(b"", final=True))
+            assert lines == expected
+
+        # Small chunks and queues so that chunks split lines and queues fill
+        monkeypatch.setitem(configuration, "async_chunk_size", 64)
+        monkeypatch.setitem(configuration, "async_queue_size", 2)
+
+        with temp_dir(
+            "Test_wfp_rainfall_asynchronous",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            sequential_dir = join(tempdir, "sequential")
+            makedirs(sequential_dir)
+            sequential, sequential_errors, sequential_report = run_pipeline(
+                sequential_dir, report=True
+            )
+            assert "queues" not in sequential_report
+            for engine in ("row", "columnar"):
+                if engine == "columnar":
+                    pytest.importorskip("numpy")
+                asynchronous_dir = join(tempdir, engine)
+                makedirs(asynchronous_dir)
+                asynchronous, asynchronous_errors, asynchronous_report = run_pipeline(
+                    asynchronous_dir, engine=engine, report=True, asynchronous=True
+                )
+                assert asynchronous.dates == sequential.dates
+                assert asynchronous_errors == sequential_errors
+                assert (
+                    asynchronous_report["countries"] == (sequential_report["countries"])
+                )
+                assert asynchronous_report["outputs"] == sequential_report["outputs"]
+                queues = asynchronous_report["queues"]
+                assert sorted(queues) == ["chunks", "countries", "lines"]
+                assert queues["chunks"]["maxsize"] == 2
+                assert queues["chunks"]["max_depth"] <= 2
+                for name in sequential.get_outputs():
                     assert_files_same(
-                        join(fixtures_dir, "hdx_hapi_rainfall_global_1yr.csv"),
-                        join(tempdir, "hdx_hapi_rainfall_global_1yr.csv"),
+                        join(sequential_dir, name), join(asynchronous_dir, name)
                     )
+
+            # A download failing part way through removes the rows of its
+            # country that were already written
+            stream_chunks = Pipeline._stream_chunks
+
+            async def fail_part_way(self, source, chunks):
+                if source.countryiso3 == "MOZ":
+                    put = chunks.put
+                    puts = Counter()
+
+                    async def put_until_dropped(item):
+                        if isinstance(item, bytes):
+                            puts["chunks"] += 1
+                            if puts["chunks"] > 200:
+                                raise DownloadError("Connection dropped!")
+                        await put(item)
+
+                    chunks.put = put_until_dropped
+                await stream_chunks(self, source, chunks)
+
+            monkeypatch.setattr(Pipeline, "_stream_chunks", fail_part_way)
+            saved_dir = join(tempdir, "saved")
+            copytree(input_dir, saved_dir)
+            write_repeated(
+                join(input_dir, "download-moz-rainfall-adm2-5ytd.csv"),
+                join(saved_dir, "download-moz-rainfall-adm2-5ytd.csv"),
+            )
+            afg_dir = join(tempdir, "afg")
+            makedirs(afg_dir)
+            afg, _, _ = run_pipeline(afg_dir, countries=("AFG",))
+            dropped_dir = join(tempdir, "dropped")
+            makedirs(dropped_dir)
+            dropped, dropped_errors, _ = run_pipeline(
+                dropped_dir,
+                saved_dir=saved_dir,
+                countries=("AFG", "MOZ"),
+                asynchronous=True,
+            )
+            assert list(dropped.get_outputs()) == list(afg.get_outputs())
+            for name in afg.get_outputs():
+                assert_files_same(join(afg_dir, name), join(dropped_dir, name))
+            assert dropped_errors == {
+                "error": {
+                    "Rainfall - moz-rainfall-subnational": {
+                        "Rainfall - moz-rainfall-subnational - Could not download "
+                        "resource"
+                    }
+                },
+                "warning": {},
+                "hdx_error": {},
+            }
+
+            # A transform failing part way through a file stops its stream
+            # rather than leave it waiting on a full queue
+            monkeypatch.setattr(Pipeline, "_stream_chunks", stream_chunks)
+            streams = {}
+
+            async def record_stream(self, source, chunks):
+                streams[source.countryiso3] = asyncio.current_task()
+                await stream_chunks(self, source, chunks)
+
+            transform_country = Pipeline._transform_country
+
+            def fail_transform(self, source, path, hrp, gho):
+                if source.countryiso3 == "MOZ":
+                    next(iter(path))
+                    raise csv.Error("Bad line!")
+                stream = streams["MOZ"]
+                for _ in range(500):
+                    if stream.done():
+                        break
+                    sleep(0.01)
+                assert stream.cancelled()
+                return transform_country(self, source, path, hrp, gho)
+
+            monkeypatch.setattr(Pipeline, "_stream_chunks", record_stream)
+            monkeypatch.setattr(Pipeline, "_transform_country", fail_transform)
+            failed_dir = join(tempdir, "failed")
+            makedirs(failed_dir)
+            failed, failed_errors, _ = run_pipeline(
+                failed_dir,
+                saved_dir=saved_dir,
+                countries=("MOZ", "AFG"),
+                asynchronous=True,
+            )
+            for name in afg.get_outputs():
+                assert_files_same(join(afg_dir, name), join(failed_dir, name))
+            assert failed_errors["error"] == {
+                "Rainfall - moz-rainfall-subnational": {
+                    "Rainfall - moz-rainfall-subnational - Could not read resource"
+                }
+            }
+
+    def test_constant_memory(
+        self, configuration, search_datasets, monkeypatch, run_pipeline
+    ):
+        # Small chunks so that rows held as text are written several times
+        monkeypatch.setitem(configuration, "write_chunk_size", 4096)
+
+        with pytest.raises(ValueError):
+            Pipeline(
+                configuration,
+                None,
+                "",
+                None,
+                parse_date("2025-07-08"),
+                engine="columnar",
+                constant_memory=True,
+            )
+        with temp_dir(
+            "Test_wfp_rainfall_constant_memory",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            default_dir = join(tempdir, "default")
+            constant_dir = join(tempdir, "constant")
+            makedirs(default_dir)
+            makedirs(constant_dir)
+            default, default_errors, default_report = run_pipeline(
+                default_dir, state_dir=join(default_dir, "state"), report=True
+            )
+            constant, constant_errors, constant_report = run_pipeline(
+                constant_dir,
+                state_dir=join(constant_dir, "state"),
+                report=True,
+                constant_memory=True,
+            )
+            with open(join(default_dir, "state", "manifest.json")) as fp:
+                default_manifest = json.load(fp)
+            with open(join(constant_dir, "state", "manifest.json")) as fp:
+                constant_manifest = json.load(fp)
+            assert len(default.dates) > 2
+            assert constant.dates == {min(default.dates), max(default.dates)}
+            assert constant_errors == default_errors
+            assert constant_report["constant_memory"] is True
+            assert constant_report["countries"] == default_report["countries"]
+            assert constant_manifest["countries"] == default_manifest["countries"]
+            for name in default.get_outputs():
+                assert_files_same(join(default_dir, name), join(constant_dir, name))